@@ -0,0 +1,138 @@
+"""代替レシピを1つずつ追加／置き換えたときの、生産計画の変化を計算します。
+
+すべての候補を含めたモデルを1つ作成し、候補のレシピの上限を0にして無効にしておきます。
+評価ごとに1つの候補だけを有効にして計算するため、モデルは作り直しません。
+評価は候補ごとに分割して、プロセスプールで並列に行います。
+"""
+import logging
+import multiprocessing
+import os
+import threading
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+from catalog import Catalog, get_catalog
+from dataset import Dataset
+from linerprog import get_planner
+
+# 評価を行うプロセス数。0の場合はリクエストを処理するプロセスで順に計算します。
+ALTERNATE_WORKERS = int(os.environ.get('SF_ALTERNATE_WORKERS', os.cpu_count() or 1))
+
+# 1つの評価 (label: (レシピのID, 'add' または 'swap')、disabled: 無効にするレシピ)
+Evaluation = namedtuple('Evaluation', ['label', 'disabled'])
+# 評価の結果 (raw: 材料の消費量の合計、power: 消費電力、buildings: 施設数の合計)
+PlanSummary = namedtuple('PlanSummary', ['label', 'status', 'raw', 'power', 'buildings'])
+
+_executor: ProcessPoolExecutor | None = None
+_executor_lock = threading.Lock()
+
+
+def evaluate(dataset: Dataset, recipe_ids: list[str], products: list[tuple[str, float]],
+             ingredients: list[str], evaluations: list[Evaluation]) -> list[PlanSummary]:
+    """候補を含めたモデルで、評価を順に計算します。"""
+    planner = get_planner(dataset, recipe_ids)
+    results = []
+    with planner.lock:
+        for evaluation in evaluations:
+            net, consum, _ = planner.solve(products, ingredients, evaluation.disabled)
+            raw = sum(-net.get(id, 0) for id in set(ingredients) if net.get(id, 0) < 0)
+            buildings = sum(planner.get_building_counts().values())
+            results.append(PlanSummary(evaluation.label, planner.status,
+                                       round(raw, 3), consum, buildings))
+    return results
+
+
+def primary_product(catalog: Catalog, recipe_id: str) -> str | None:
+    recipe = catalog.recipes[recipe_id]
+    return recipe.products[0].item_id if recipe.products else None
+
+
+def make_evaluations(catalog: Catalog, base_ids: list[str],
+                     candidates: list[str]) -> list[Evaluation]:
+    """基準の計画と、候補ごとの追加(add)／置き換え(swap)の評価を作ります。
+
+    置き換えでは、候補と主生産物が同じ基準のレシピを無効にします。
+    """
+    all_candidates = frozenset(candidates)
+    evaluations = [Evaluation(None, all_candidates)]
+    for id in candidates:
+        disabled = all_candidates - {id}
+        evaluations.append(Evaluation((id, 'add'), disabled))
+
+        item_id = primary_product(catalog, id)
+        replaced = {base_id for base_id in base_ids
+                    if primary_product(catalog, base_id) == item_id}
+        if replaced:
+            evaluations.append(Evaluation((id, 'swap'), disabled | replaced))
+    return evaluations
+
+
+def get_executor() -> ProcessPoolExecutor | None:
+    global _executor
+    # 複数のスレッドから同時に呼ばれても、プールは1つだけ作ります。
+    with _executor_lock:
+        if _executor is None and ALTERNATE_WORKERS > 0:
+            import planworker
+            try:
+                _executor = ProcessPoolExecutor(
+                    ALTERNATE_WORKERS, mp_context=multiprocessing.get_context('spawn'),
+                    initializer=planworker.init_worker)
+            except OSError:
+                # Lambdaなど、プロセスプールが使えない環境では順に計算します。
+                logging.warning('process pool is not available, evaluating serially')
+        return _executor
+
+
+def run_evaluations(dataset: Dataset, recipe_ids: list[str],
+                    products: list[tuple[str, float]], ingredients: list[str],
+                    evaluations: list[Evaluation]) -> list[PlanSummary]:
+    executor = get_executor()
+    if executor is None:
+        return evaluate(dataset, recipe_ids, products, ingredients, evaluations)
+
+    import planworker
+    chunk_count = min(ALTERNATE_WORKERS, len(evaluations))
+    chunks = [evaluations[i::chunk_count] for i in range(chunk_count)]
+    futures = [executor.submit(planworker.evaluate, dataset.path, recipe_ids,
+                               products, ingredients, chunk)
+               for chunk in chunks]
+    return [summary for future in futures for summary in future.result()]
+
+
+def rank_alternates(dataset: Dataset, base_ids: list[str],
+                    products: list[tuple[str, float]], ingredients: list[str],
+                    candidates: list[str]) -> dict:
+    """候補の代替レシピを、材料の消費量・電力・施設数が減る順に並べて返します。"""
+    catalog = get_catalog(dataset)
+    base_ids = [id for id in dict.fromkeys(base_ids) if id in catalog.recipes]
+    candidates = [id for id in dict.fromkeys(candidates)
+                  if id in catalog.recipes and id not in base_ids]
+
+    evaluations = make_evaluations(catalog, base_ids, candidates)
+    summaries = run_evaluations(dataset, base_ids + candidates, products, ingredients,
+                                evaluations)
+    base = next(s for s in summaries if s.label is None)
+
+    ranked = []
+    for s in summaries:
+        if s.label is None or s.status != 'Optimal':
+            continue
+        recipe_id, mode = s.label
+        ranked.append({
+            'recipe': recipe_id,
+            'mode': mode,
+            'raw': s.raw,
+            'power': s.power,
+            'buildings': s.buildings,
+            'deltaRaw': round(s.raw - base.raw, 3),
+            'deltaPower': round(s.power - base.power, 3),
+            'deltaBuildings': s.buildings - base.buildings,
+        })
+    ranked.sort(key=lambda r: (r['deltaRaw'], r['deltaPower'], r['deltaBuildings'],
+                               r['recipe'], r['mode']))
+
+    return {
+        'base': {'status': base.status, 'raw': base.raw, 'power': base.power,
+                 'buildings': base.buildings},
+        'alternates': ranked,
+    }
@@ -1,32 +1,193 @@
-
+import functools
+import hmac
+import math
 import os
-from flask import Flask, request, jsonify
+import time
+from collections import namedtuple
+from flask import Flask, request, jsonify, g, abort, has_request_context
 from flask_cors import CORS
-from flask_migrate import Migrate
-from sqlalchemy import orm, asc, desc
-import serverless_wsgi
-
+from sqlalchemy import Engine, event, orm, asc, desc
+from werkzeug.datastructures import MultiDict
+
+from catalog import get_catalog
+from dataset import Dataset, DatasetManager, build_dataset, is_stale
+from dbprofile import engine_options
+from jsonprovider import init_json_provider
+import metrics
 from models import db, Item, Building, Recipe, RecipeItem, Condition, ConditionItem
-from seeddata import make_seeddata
-from linerprog import ProductionPlanner
+from planstore import PlanStore
+from production import get_production_tree
+from search import get_search_index
+from singleflight import SingleFlight
+from unlock import get_unlock_index
 
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 
+# 起動モード
+#   full: import時にデータセットを確認し、古ければ作成し直します。(デフォルト)
+#   lazy: import時にDBの準備を行いません。DBが作成済みの本番環境向けです。
+STARTUP_MODE = os.environ.get('SF_STARTUP_MODE', 'full')
+
+# ビルド済みのデータセット(dataset.pyで作成します)
+DATASET_PATH = os.environ.get('SF_DATASET_PATH', os.path.join(BASE_DIR, 'satisfactory.db'))
+
+# DB接続のプロファイル(dbprofile.py)
+#   default : 通常の読み書き可能な接続
+#   readonly: データセットを読み取り専用・mmapで開きます。本番環境向けです。
+DB_PROFILE = os.environ.get('SF_DB_PROFILE', 'default')
+
+# プランナーの計算結果を保存するSQLiteファイル。未設定の場合は保存しません。
+#   Lambdaではコンテナをまたいで使えるように、EFSなどのパスを指定します。
+PLAN_STORE_PATH = os.environ.get('SF_PLAN_STORE_PATH')
+PLAN_STORE_MAX_BYTES = int(os.environ.get('SF_PLAN_STORE_MAX_BYTES', 64 * 1024 * 1024))
+# 計算結果のファイルのジャーナルモード(planstore.py)
+#   delete: ロールバックジャーナル。EFSなどのネットワークファイルシステムでも使えます。(デフォルト)
+#   wal   : 1台のホストのローカルディスクで、複数のプロセスから使う場合に高速です。
+PLAN_STORE_JOURNAL_MODE = os.environ.get('SF_PLAN_STORE_JOURNAL_MODE', 'delete')
+
+# レスポンスのJSONを作成するプロバイダ(jsonprovider.py)
+#   default: Flask標準のプロバイダ (日本語などは\uでエスケープされます)
+#   orjson : orjsonを使います。高速ですが、日本語などはUTF-8のまま出力されます。
+JSON_PROVIDER = os.environ.get('SF_JSON_PROVIDER', 'default')
+
+# データセットの入れ替えなど、管理用APIのトークン。未設定の場合は管理用APIを無効にします。
+ADMIN_TOKEN = os.environ.get('SF_ADMIN_TOKEN')
+
+# プランナーの入力 (linerprog.solve_planのdataset以降の引数)
+PlannerRequest = namedtuple('PlannerRequest', ['recipe_ids', 'products', 'ingredients', 'flows'])
+
 app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{os.path.join(BASE_DIR, "satisfactory.db")}'
+app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{DATASET_PATH}'
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(DB_PROFILE, DATASET_PATH)
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 CORS(app)
+init_json_provider(app, JSON_PROVIDER)
 
 db.init_app(app)
-migrate = Migrate(app, db)
 
-with app.app_context():
-    db.create_all()
 
-    # 最初の実行時はシードデータを設定します。
-    if not Item.query.first():
-        db.session.add_all(make_seeddata(db))
-        db.session.commit()
+def init_db(precompute: bool = False) -> None:
+    """データセットがないか、シードデータより古い場合は作成し直します。
+
+    import時に呼ばれるため、デフォルトでは生産計画の計算(プロセスプールを使い数秒かかります)
+    は行いません。計画は/api/v1/item/<素材のID>/planの最初の要求時に素材ごとに計算されます。
+    precomputeがTrueの場合は、import時に計画なしで作成したデータセットも作り直します。
+    """
+    if is_stale(DATASET_PATH, precompute):
+        app.logger.info('dataset is stale, rebuilding %s', DATASET_PATH)
+        build_dataset(DATASET_PATH, precompute=precompute)
+        db.engine.dispose()
+
+
+@app.cli.command('init-db')
+def init_db_command():
+    """データセットを必要に応じて、生産計画の計算も含めて作成し直します。"""
+    init_db(precompute=True)
+
+
+if STARTUP_MODE == 'full':
+    # flask db コマンドはfullモードでのみ使えます。
+    from flask_migrate import Migrate
+    migrate = Migrate(app, db)
+
+    with app.app_context():
+        init_db()
+
+# 同じ内容のプランナーの計算を、同時に1回だけ行います。
+planner_flight = SingleFlight('planner')
+plan_store = (PlanStore(PLAN_STORE_PATH, PLAN_STORE_MAX_BYTES, PLAN_STORE_JOURNAL_MODE)
+              if PLAN_STORE_PATH else None)
+
+datasets = DatasetManager(DB_PROFILE)
+datasets.warmers.append(get_search_index)
+datasets.warmers.append(get_unlock_index)
+datasets.open(DATASET_PATH)
+
+
+@app.before_request
+def pin_dataset():
+    """リクエストの処理中は、開始時のデータセットを使い続けます。"""
+    g.dataset = datasets.current
+    g.request_start = time.perf_counter()
+    g.db_queries = 0
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def count_db_query(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and 'db_queries' in g:
+        g.db_queries += 1
+
+
+@app.after_request
+def record_request(response):
+    if 'request_start' in g:
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        metrics.REQUEST_SECONDS.observe(time.perf_counter() - g.request_start,
+                                        route, request.method, response.status_code)
+        metrics.REQUEST_DB_QUERIES.observe(g.db_queries, route)
+    return response
+
+
+def dataset_cache_stats() -> dict[tuple, float]:
+    values = {}
+    for name, (hits, misses) in datasets.current.cache_stats.items():
+        values[(name, 'hit')] = hits
+        values[(name, 'miss')] = misses
+    return values
+
+
+metrics.Gauge('sf_dataset_cache_requests',
+              'Dataset cache lookups by cache and result. Resets when the dataset is swapped.',
+              ['cache', 'result'], dataset_cache_stats)
+
+
+def cache_by_dataset(*arg_names: str):
+    """レスポンスをデータセットごとにキャッシュします。
+
+    キーにはURLのパラメータとarg_namesで指定したクエリパラメータを使います。
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(**kwargs):
+            key = (view.__name__, tuple(sorted(kwargs.items())),
+                   tuple(request.args.get(name) for name in arg_names))
+
+            def render() -> tuple[bytes, str]:
+                response = view(**kwargs)
+                return response.get_data(), response.mimetype
+
+            data, mimetype = g.dataset.cached_response(key, render)
+            return app.response_class(data, mimetype=mimetype)
+        return wrapper
+    return decorator
+
+
+def json_body(obj: any) -> bytes:
+    """jsonifyと同じ形式(デバッグ時以外は区切りの空白なし)で、レスポンスの本文を作成します。"""
+    return app.json.response(obj).get_data()
+
+
+def split_ids(value: str) -> list[str]:
+    """カンマ区切りのIDのリストを分割します。"""
+    return [id.strip() for id in value.split(',') if id.strip()]
+
+
+def unlock_mask(args: MultiDict, dataset: Dataset) -> int | None:
+    """クエリパラメータの開放状態から、使えるレシピのビットセットを返します。
+
+    tier: 達成したティア, milestones/researches: 達成したマイルストーン/研究のID
+    いずれも指定されていない場合はNoneを返します。
+    """
+    tier = args.get('tier')
+    milestones = split_ids(args.get('milestones', ''))
+    researches = split_ids(args.get('researches', ''))
+    if tier is None and not milestones and not researches:
+        return None
+    if tier is not None and not tier.isdigit():
+        abort(400)
+
+    return get_unlock_index(dataset).mask(
+        int(tier) if tier is not None else None, milestones, researches)
 
 
 def items_by_category(items: list[Item]) -> list[tuple[str, list[dict]]]:
@@ -47,6 +208,7 @@ def items_by_category(items: list[Item]) -> list[tuple[str, list[dict]]]:
 
 # AWS Lambda用のハンドラーを設定
 def handler(event, context):
+    import serverless_wsgi
     return serverless_wsgi.handle_request(app, event, context)
 
 
@@ -56,6 +218,7 @@ def echo():
 
 
 @app.get('/api/v1/items')
+@cache_by_dataset('grouping')
 def items():
     items = Item.query.all()
     grouping = request.args.get('grouping', False)
@@ -67,19 +230,43 @@ def items():
     return jsonify(items)
 
 
+@app.get('/api/v1/search')
+def search():
+    """素材・建築物・レシピを名前かIDの部分一致で検索します。
+
+    limit: 返す件数 (1～100、デフォルトは20)
+    """
+    query = request.args.get('q', '')
+    try:
+        limit = int(request.args.get('limit', '20'))
+    except ValueError:
+        abort(400)
+    limit = max(1, min(limit, 100))
+    entries = get_search_index(g.dataset).search(query, limit)
+    return jsonify([{'kind': entry.kind, 'id': entry.id, 'name': entry.name}
+                    for entry in entries])
+
+
 @app.get('/api/v1/recipes')
+@cache_by_dataset('page', 'count', 'tier', 'milestones', 'researches')
 def recipes():
     page = int(request.args.get('page', '0'))
     count = int(request.args.get('count', '50'))
-    recipes = (Recipe.query
-               .order_by(asc(Recipe.index))
-               .offset(page * count)
-               .limit(count)
-               .all())
+    query = Recipe.query.order_by(asc(Recipe.index))
+
+    mask = unlock_mask(request.args, g.dataset)
+    if mask is None:
+        query = query.offset(page * count).limit(count)
+    else:
+        # 開放済みのレシピをビットセットで絞り込み、そのページの分だけを読み込みます。
+        ids = get_unlock_index(g.dataset).select(mask)
+        query = query.filter(Recipe.id.in_(ids[page * count:(page + 1) * count]))
+    recipes = query.all()
     return jsonify([recipe.to_dict() for recipe in recipes])
 
 
 @app.get('/api/v1/item/<string:item_id>/recipes/producing')
+@cache_by_dataset()
 def recipes_producing(item_id: str):
     recipes = (Recipe.query.join(RecipeItem)
         .filter(RecipeItem.item_id == item_id)
@@ -102,6 +289,7 @@ def get_using_recipes_query(item_id: str) -> tuple[orm.Query, type[RecipeItem]]:
 
 
 @app.get('/api/v1/item/<string:item_id>/recipes/using_for_item')
+@cache_by_dataset()
 def recipes_using_for_item(item_id: str):
     query, product_alias = get_using_recipes_query(item_id)
     recipes = (query
@@ -115,6 +303,7 @@ def recipes_using_for_item(item_id: str):
 
 
 @app.get('/api/v1/item/<string:item_id>/recipes/using_for_building')
+@cache_by_dataset()
 def recipes_using_for_building(item_id: str):
     query, product_alias = get_using_recipes_query(item_id)
     recipes = (query
@@ -127,7 +316,88 @@ def recipes_using_for_building(item_id: str):
     return jsonify([recipe.to_dict() for recipe in recipes])
 
 
+@app.get('/api/v1/item/<string:item_id>/tree')
+def production_tree(item_id: str):
+    """素材の生産に必要な上流の素材を、DAGとして返します。
+
+    recipes: 標準のレシピの代わりに使うレシピ(代替レシピなど)のID。カンマ区切りで指定します。
+    rate   : 1分あたりの生産数。デフォルトは1です。
+    """
+    if item_id not in get_catalog(g.dataset).items:
+        abort(404)
+
+    try:
+        rate = float(request.args.get('rate', '1'))
+    except ValueError:
+        abort(400)
+    if not 0 <= rate < math.inf:
+        abort(400)
+
+    tree = get_production_tree(g.dataset, split_ids(request.args.get('recipes', '')))
+    return jsonify(tree.to_dict(item_id, rate))
+
+
+@app.get('/api/v1/costs')
+@cache_by_dataset('recipes')
+def costs():
+    """すべての素材について、1分あたり1個を作るのに必要な基本資源・電力・施設数を返します。
+
+    recipes: 標準のレシピの代わりに使うレシピのID。カンマ区切りで指定します。
+    """
+    # numpyの読み込みは重いため、起動時間に影響しないように必要になってから読み込みます。
+    from costs import get_cost_table
+    return jsonify(get_cost_table(g.dataset, split_ids(request.args.get('recipes', ''))))
+
+
+@app.get('/api/v1/unlock_cost')
+@cache_by_dataset('tier', 'milestones', 'researches', 'recipes')
+def unlock_cost():
+    """マイルストーン/研究の達成に必要な素材と基本資源の合計を返します。
+
+    tier: このティアまでのマイルストーンをすべて含めます。
+    milestones/researches: 含めるマイルストーン/研究のID。カンマ区切りで指定します。
+    recipes: 基本資源の計算で、標準のレシピの代わりに使うレシピのID。
+    """
+    tier = request.args.get('tier')
+    if tier is not None and not tier.isdigit():
+        abort(400)
+    condition_ids = (split_ids(request.args.get('milestones', ''))
+                     + split_ids(request.args.get('researches', '')))
+
+    from costs import get_unlock_cost
+    return jsonify(get_unlock_cost(g.dataset, int(tier) if tier is not None else None,
+                                   condition_ids,
+                                   split_ids(request.args.get('recipes', ''))))
+
+
+@app.get('/api/v1/item/<string:item_id>/plan')
+def item_plan(item_id: str):
+    """素材を毎分rate個生産する、データセットの作成時に計算した最適な計画を返します。
+
+    rate: 毎分の生産量 (デフォルトは100)
+    objective: raw(材料の消費量、デフォルト)、power(消費電力)、buildings(施設数)の
+               いずれかを最小にした計画を返します。
+    レスポンスはプランナーと同じ形式で、recipesはレシピのIDをキーに、使うレシピだけを含みます。
+    """
+    # pulpの読み込みは重いため、最初の実行時まで遅らせます。
+    from precompute import PLAN_OBJECTIVES, get_precomputed_plan
+
+    objective = request.args.get('objective', 'raw')
+    try:
+        rate = float(request.args.get('rate', 100))
+    except ValueError:
+        abort(400)
+    if objective not in PLAN_OBJECTIVES or not 0 <= rate < math.inf:
+        abort(400)
+
+    result = get_precomputed_plan(g.dataset, item_id, objective, rate)
+    if result is None:
+        abort(404)
+    return jsonify(result)
+
+
 @app.get('/api/v1/item/<string:item_id>/milestones')
+@cache_by_dataset()
 def milestones(item_id: str):
     milestones = (Condition.query
         .filter(Condition.kind == 'milestone')
@@ -140,6 +410,7 @@ def milestones(item_id: str):
 
 
 @app.get('/api/v1/item/<string:item_id>/researches')
+@cache_by_dataset()
 def research(item_id: str):
     researches = (Condition.query
         .filter(Condition.kind == 'research')
@@ -151,8 +422,47 @@ def research(item_id: str):
     return jsonify([research.to_dict() for research in researches])
 
 
-@app.get('/api/v1/planner')
-def planner():
+def check_admin() -> None:
+    if not ADMIN_TOKEN:
+        abort(404)
+    authorization = request.headers.get('Authorization', '')
+    if not hmac.compare_digest(authorization, f'Bearer {ADMIN_TOKEN}'):
+        abort(403)
+
+
+@app.get('/metrics')
+def metrics_endpoint():
+    """メトリクスをPrometheusのテキスト形式で返します。"""
+    return app.response_class(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
+@app.get('/api/v1/admin/dataset')
+def dataset_status():
+    check_admin()
+    return jsonify(datasets.status())
+
+
+@app.post('/api/v1/admin/dataset')
+def reload_dataset():
+    """データセットをバックグラウンドで読み込み、完了後に入れ替えます。
+
+    パスは現在のデータセットと同じディレクトリにあるファイル名で指定します。
+    """
+    check_admin()
+    name = (request.get_json(silent=True) or {}).get('path', '')
+    path = os.path.join(os.path.dirname(DATASET_PATH), os.path.basename(name))
+    if not name or not os.path.isfile(path):
+        abort(404)
+
+    started = datasets.load_async(path)
+    return jsonify(datasets.status()), 202 if started else 409
+
+
+def planner_request(args: MultiDict, dataset: Dataset) -> PlannerRequest:
+    """プランナーのクエリパラメータを解析します。
+
+    ASGIのエントリポイント(asgi.py)からも、リクエストの外で使われます。
+    """
     def split_product(value: str) -> tuple[str, float]:
         index = value.find(':')
         if index >= 0:
@@ -160,24 +470,101 @@ def planner():
         else:
             return value.strip(), 100
 
-    recipes_str = request.args.get('recipes', '')
+    recipes_str = args.get('recipes', '')
     recipes_ids = [id.strip() for id in recipes_str.split(',')]
 
-    products_str = request.args.get('products', '')
+    # 開放状態が指定された場合は、開放済みのレシピだけを使います。
+    # レシピが指定されていなければ、開放済みのレシピをすべて使います。
+    mask = unlock_mask(args, dataset)
+    if mask is not None:
+        unlock = get_unlock_index(dataset)
+        if split_ids(recipes_str):
+            recipes_ids = [id for id in recipes_ids if unlock.is_unlocked(id, mask)]
+        else:
+            recipes_ids = unlock.select(mask)
+
+    products_str = args.get('products', '')
     products = [split_product(id) for id in products_str.split(',')]
 
-    ingredients_str = request.args.get('ingredients', '')
+    ingredients_str = args.get('ingredients', '')
     ingredients = [id.strip() for id in ingredients_str.split(',')]
 
-    planner = ProductionPlanner(recipes_ids, products, ingredients)
-    net, consum, power = planner.solve()
-    return jsonify({
-        'consume': consum,
-        'power': power,
-        'net': net,
-        'buildings': planner.get_building_counts(),
-        'recipes': planner.get_recipe_counts(),
-    })
+    # レシピ間の素材の流れ(Sankey図用)を含めるかどうか
+    flows = args.get('flows', '') not in ('', '0', 'false')
+
+    return PlannerRequest(recipes_ids, products, ingredients, flows)
+
+
+def planner_key(planner_req: PlannerRequest, dataset: Dataset) -> tuple:
+    """同じ計算結果になるプランナーの入力が、同じキーになるようにします。
+
+    レシピと材料は集合として扱い、順番や重複を無視します。
+    """
+    return (dataset.version,
+            tuple(sorted(set(planner_req.recipe_ids) - {''})),
+            tuple(sorted(planner_req.products)),
+            tuple(sorted(set(planner_req.ingredients) - {''})),
+            planner_req.flows)
+
+
+@app.get('/api/v1/planner')
+def planner():
+    # pulpの読み込みは重いため、最初のプランナー実行時まで遅らせます。
+    from linerprog import solve_plan
+
+    dataset = g.dataset
+
+    def solve() -> bytes:
+        result, stats = solve_plan(dataset, *planner_req)
+        metrics.observe_plan(stats)
+        data = json_body(result)
+        if plan_store is not None:
+            plan_store.put(key, dataset.version, data)
+        return data
+
+    planner_req = planner_request(request.args, dataset)
+    key = planner_key(planner_req, dataset)
+    data = plan_store.get(key) if plan_store is not None else None
+    if data is None:
+        data = planner_flight.do(key, solve)
+    return app.response_class(data, mimetype='application/json')
+
+
+@app.get('/api/v1/planner/alternates')
+@cache_by_dataset('recipes', 'products', 'ingredients', 'tier', 'milestones', 'researches',
+                  'candidates')
+def planner_alternates():
+    """基準の計画に代替レシピを1つずつ追加／置き換えたときの変化を、良い順に返します。
+
+    パラメータはプランナーと同じです。開放状態だけを指定した場合は、開放済みの
+    通常レシピを、レシピも開放状態も指定しない場合はすべての通常レシピを基準の計画に使います。
+    存在しないレシピのIDは無視します。
+    candidates: 評価する代替レシピのID。省略時は開放済み(開放状態を指定しない場合は
+                すべて)の代替レシピを評価します。
+    """
+    # pulpの読み込みは重いため、最初の実行時まで遅らせます。
+    from alternates import rank_alternates
+
+    dataset = g.dataset
+    catalog = get_catalog(dataset)
+    planner_req = planner_request(request.args, dataset)
+    alternates = [recipe.id for recipe in catalog.recipes.values() if recipe.alternate]
+
+    base_ids = [id for id in planner_req.recipe_ids if id in catalog.recipes]
+    if not split_ids(request.args.get('recipes', '')):
+        if unlock_mask(request.args, dataset) is None:
+            base_ids = list(catalog.recipes)
+        base_ids = [id for id in base_ids if not catalog.recipes[id].alternate]
+
+    candidates = split_ids(request.args.get('candidates', ''))
+    if not candidates:
+        mask = unlock_mask(request.args, dataset)
+        unlock = get_unlock_index(dataset)
+        candidates = [id for id in alternates
+                      if mask is None or unlock.is_unlocked(id, mask)]
+
+    return jsonify(rank_alternates(dataset, base_ids, planner_req.products,
+                                   planner_req.ingredients, candidates))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,226 @@
+"""ASGIのエントリポイントです。
+
+    uvicorn asgi:application
+
+プランナー(/api/v1/planner)の計算はプロセスプールで行い、それ以外のエンドポイントは
+Flaskのアプリで処理します。CBCの計算が重なっても、素材一覧などの軽いリクエストが
+待たされないようにします。
+
+Flaskのアプリはスレッドプールで処理します。asgirefのWsgiToAsgiは1つのスレッドで
+すべてのリクエストを順に処理するため、代替レシピの評価のような重いリクエストの間、
+他のリクエストが待たされてしまいます。
+
+プールの処理数と待ち行列には上限があり、超えたリクエストには503を返します。
+ワーカーが異常終了した場合はプールを作り直して1回だけ再試行し、それでも失敗すれば503を返します。
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from urllib.parse import parse_qsl
+from asgiref.sync import sync_to_async
+from asgiref.wsgi import WsgiToAsgi, WsgiToAsgiInstance
+from werkzeug.datastructures import MultiDict
+from werkzeug.exceptions import HTTPException
+
+import metrics
+import planworker
+from app import app, datasets, json_body, plan_store, planner_key, planner_request
+from singleflight import AsyncSingleFlight
+
+# プランナーの計算を行うプロセス数
+PLANNER_WORKERS = int(os.environ.get('SF_PLANNER_WORKERS', os.cpu_count() or 1))
+
+# 計算待ちにできるプランナーのリクエスト数。超えた場合は503を返します。
+PLANNER_QUEUE = int(os.environ.get('SF_PLANNER_QUEUE', PLANNER_WORKERS * 4))
+
+# Flaskのアプリでリクエストを処理するスレッド数
+WSGI_THREADS = int(os.environ.get('SF_WSGI_THREADS', 16))
+
+PLANNER_PATH = '/api/v1/planner'
+
+
+class PlannerPool:
+    """プランナーの計算を行うプロセスプールです。
+
+    イベントループのスレッドからのみ使うため、カウンタにロックは使いません。
+    """
+
+    def __init__(self, workers: int, queue: int):
+        self.workers = workers
+        self.limit = workers + queue
+        self.pending = 0
+        self.rejected = 0
+        self.restarts = 0
+        self._executor: ProcessPoolExecutor | None = None
+
+    @property
+    def executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                self.workers, mp_context=multiprocessing.get_context('spawn'),
+                initializer=planworker.init_worker)
+        return self._executor
+
+    def is_full(self) -> bool:
+        return self.pending >= self.limit
+
+    async def solve(self, request: tuple, dataset_path: str) -> tuple[dict, tuple]:
+        """プールで計算します。プールが壊れた場合は作り直して1回だけ再試行します。
+
+        再試行でも壊れた場合はBrokenProcessPoolを送出します。
+        """
+        loop = asyncio.get_running_loop()
+        self.pending += 1
+        try:
+            for retry in (False, True):
+                executor = self.executor
+                try:
+                    return await loop.run_in_executor(executor, planworker.solve,
+                                                      dataset_path, *request)
+                except BrokenProcessPool:
+                    # CBCのクラッシュやOOMでワーカーが終了すると、プール全体が使えなくなります。
+                    logging.warning('planner pool is broken, restarting it')
+                    self.reset(executor)
+                    if retry:
+                        raise
+        finally:
+            self.pending -= 1
+
+    def reset(self, executor: ProcessPoolExecutor) -> None:
+        """壊れたプールを破棄します。次の計算で新しいプールを作ります。
+
+        同時に失敗した他のリクエストが、作り直したプールを破棄しないようにします。
+        """
+        if self._executor is executor:
+            self._executor = None
+            self.restarts += 1
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def status(self) -> dict:
+        return {
+            'workers': self.workers,
+            'running': min(self.pending, self.workers),
+            'queued': max(self.pending - self.workers, 0),
+            'limit': self.limit,
+            'rejected': self.rejected,
+            'restarts': self.restarts,
+        }
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+            self._executor = None
+
+
+wsgi_executor = ThreadPoolExecutor(WSGI_THREADS, thread_name_prefix='wsgi')
+
+
+class ThreadPoolWsgiToAsgiInstance(WsgiToAsgiInstance):
+    # 1つのスレッドを共有せず、wsgi_executorのスレッドで実行します。
+    run_wsgi_app = sync_to_async(WsgiToAsgiInstance.__dict__['run_wsgi_app'].func,
+                                 thread_sensitive=False, executor=wsgi_executor)
+
+
+class ThreadPoolWsgiToAsgi(WsgiToAsgi):
+    """WsgiToAsgiと同じですが、WSGIのアプリをスレッドプールで並行に実行します。"""
+
+    async def __call__(self, scope, receive, send):
+        await ThreadPoolWsgiToAsgiInstance(self.wsgi_application, self.duplicate_header_limit)(
+            scope, receive, send)
+
+
+planner_pool = PlannerPool(PLANNER_WORKERS, PLANNER_QUEUE)
+planner_flight = AsyncSingleFlight('planner')
+metrics.Gauge('sf_planner_pool', 'Planner process pool state.', ['state'],
+              lambda: {(k,): v for k, v in planner_pool.status().items()})
+wsgi_application = ThreadPoolWsgiToAsgi(app)
+
+
+async def send_json(send, status: int, body: bytes, headers: list = ()) -> None:
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json'),
+                    # flask_corsの設定(CORS(app))と同じく、すべてのオリジンを許可します。
+                    (b'access-control-allow-origin', b'*'),
+                    *headers],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def planner(scope, receive, send) -> None:
+    start = time.perf_counter()
+    status = await solve_planner(scope, send)
+    # Flaskを通らないため、app.record_requestの代わりに記録します。
+    metrics.REQUEST_SECONDS.observe(time.perf_counter() - start,
+                                    PLANNER_PATH, 'GET', status)
+
+
+async def solve_planner(scope, send) -> int:
+    dataset = datasets.current
+    args = MultiDict(parse_qsl(scope['query_string'].decode('latin-1')))
+    try:
+        request = planner_request(args, dataset)
+    except HTTPException as ex:
+        await send_json(send, ex.code, json_body({'error': ex.name}))
+        return ex.code
+
+    # SQLiteの読み書きはイベントループを止めないように、スレッドプールで行います。
+    loop = asyncio.get_running_loop()
+    key = planner_key(request, dataset)
+    data = (await loop.run_in_executor(None, plan_store.get, key)
+            if plan_store is not None else None)
+    if data is not None:
+        await send_json(send, 200, data)
+        return 200
+
+    # 同じ内容の計算が実行中であれば、プールを使わずにその結果を待ちます。
+    if not planner_flight.in_flight(key) and planner_pool.is_full():
+        planner_pool.rejected += 1
+        await send_json(send, 503, json_body({'error': 'planner is busy'}),
+                        [(b'retry-after', b'1')])
+        return 503
+
+    async def solve() -> bytes:
+        result, stats = await planner_pool.solve(request, dataset.path)
+        metrics.observe_plan(stats)
+        data = json_body(result)
+        if plan_store is not None:
+            await loop.run_in_executor(None, plan_store.put, key, dataset.version, data)
+        return data
+
+    try:
+        data = await planner_flight.do(key, solve)
+    except BrokenProcessPool:
+        await send_json(send, 503, json_body({'error': 'planner is unavailable'}),
+                        [(b'retry-after', b'1')])
+        return 503
+
+    await send_json(send, 200, data)
+    return 200
+
+
+async def lifespan(scope, receive, send) -> None:
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            planner_pool.shutdown()
+            wsgi_executor.shutdown(cancel_futures=True)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send) -> None:
+    if scope['type'] == 'lifespan':
+        await lifespan(scope, receive, send)
+    elif (scope['type'] == 'http' and scope['path'] == PLANNER_PATH
+          and scope['method'] == 'GET'):
+        await planner(scope, receive, send)
+    else:
+        await wsgi_application(scope, receive, send)
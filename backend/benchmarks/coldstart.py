@@ -0,0 +1,89 @@
+#!/usr/bin/python
+"""Lambdaのコールドスタートを想定し、新しいプロセスでの起動時間を計測します。
+
+    python benchmarks/coldstart.py [--runs N] [--mode full|lazy ...] [--importtime]
+
+それぞれの計測は別プロセスで行い、
+  - app(handler)のimport時間
+  - 最初の /api/v1/items の応答時間
+  - 最初の /api/v1/planner の応答時間
+の中央値を表示します。--importtime を指定すると、
+`python -X importtime` によるモジュールごとのimport時間の上位を表示します。
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD_SCRIPT = '''
+import json, time
+t0 = time.perf_counter()
+from app import app, handler
+t1 = time.perf_counter()
+client = app.test_client()
+client.get('/api/v1/items')
+t2 = time.perf_counter()
+client.get('/api/v1/planner?recipes=Iron_Ingot,Iron_Plate&products=Iron_Plate:60&ingredients=Iron_Ore')
+t3 = time.perf_counter()
+print(json.dumps({'import': t1 - t0, 'first_items': t2 - t1, 'first_planner': t3 - t2}))
+'''
+
+
+def run_child(mode: str, args: list[str] = (), script: str = CHILD_SCRIPT) -> subprocess.CompletedProcess:
+    env = dict(os.environ, SF_STARTUP_MODE=mode, PYTHONPATH=BACKEND_DIR)
+    return subprocess.run([sys.executable, *args, '-c', script],
+                          cwd=BACKEND_DIR, env=env, capture_output=True,
+                          text=True, check=True)
+
+
+def measure(mode: str, runs: int) -> dict[str, float]:
+    samples = []
+    for _ in range(runs):
+        result = run_child(mode)
+        samples.append(json.loads(result.stdout.strip().splitlines()[-1]))
+
+    return {key: statistics.median(s[key] for s in samples) * 1000
+            for key in samples[0]}
+
+
+def print_importtime(mode: str, top: int) -> None:
+    """-X importtime の出力から、累積時間の大きいモジュールを表示します。"""
+    result = run_child(mode, ['-X', 'importtime'], 'import app')
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        rows.append((int(cumulative_us), int(self_us), name.rstrip()))
+
+    print(f'\n[{mode}] import time top {top} (cumulative / self, ms)')
+    for cumulative_us, self_us, name in sorted(rows, reverse=True)[:top]:
+        print(f'  {cumulative_us / 1000:8.1f} {self_us / 1000:8.1f}  {name}')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--mode', action='append', choices=['full', 'lazy'])
+    parser.add_argument('--importtime', action='store_true')
+    parser.add_argument('--top', type=int, default=15)
+    args = parser.parse_args()
+    modes = args.mode or ['full', 'lazy']
+
+    print(f'{"mode":6} {"import":>10} {"items":>10} {"planner":>10}  (median ms, {args.runs} runs)')
+    for mode in modes:
+        result = measure(mode, args.runs)
+        print(f'{mode:6} {result["import"]:10.1f} {result["first_items"]:10.1f} '
+              f'{result["first_planner"]:10.1f}')
+
+    if args.importtime:
+        for mode in modes:
+            print_importtime(mode, args.top)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,254 @@
+#!/usr/bin/python
+"""シードデータのIDからリクエストを作成し、APIに負荷をかけて計測します。
+
+    python benchmarks/loadtest.py [--url http://127.0.0.1:8000] [--mix catalog=6,item=3,planner=1]
+                                  [--requests N] [--concurrency N] [--seed N]
+                                  [--output result.json] [--baseline baseline.json]
+                                  [--max-regression PCT]
+
+--urlを指定しない場合は、プロセス内でFlaskのテストクライアントを使います。
+ルートごとのreq/sとp50/p95/p99をJSONで出力し、--baselineを指定すると
+保存済みの結果との差を表示します。--max-regressionを超えてp95が悪化したルートが
+あれば終了コード1を返すため、CIでの比較に使えます。
+"""
+import argparse
+import json
+import random
+import statistics
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import namedtuple
+from urllib.parse import quote
+
+from catalog import RAW_CATEGORIES
+from models import Item, Recipe, RecipeItem, Condition
+from seeddata import make_seedrows
+
+# routeは集計に使うルート名(Flaskのurl_ruleと同じ形式)です。
+LoadRequest = namedtuple('LoadRequest', ['group', 'route', 'url'])
+
+DEFAULT_MIX = 'catalog=6,item=3,planner=1'
+ITEM_ROUTES = ['recipes/producing', 'recipes/using_for_item', 'recipes/using_for_building',
+               'milestones', 'researches', 'tree']
+
+
+class SeedIds:
+    """リクエストの作成に使う、シードデータのIDです。"""
+
+    def __init__(self):
+        self.items = []
+        self.raw_items = []
+        self.producible = set()
+        self.milestones = []
+        self.researches = []
+        self.recipe_count = 0
+        alternates = set()
+        for model, row in make_seedrows():
+            if model is Item:
+                self.items.append((row['id'], row['name']))
+                if row['category'] in RAW_CATEGORIES:
+                    self.raw_items.append(row['id'])
+            elif model is Recipe:
+                self.recipe_count += 1
+                if row['alternate']:
+                    alternates.add(row['id'])
+            elif model is RecipeItem and row['role'] == 'product' \
+                    and row['recipe_id'] not in alternates:
+                self.producible.add(row['item_id'])
+            elif model is Condition and row['kind'] == 'milestone':
+                self.milestones.append(row['id'])
+            elif model is Condition and row['kind'] == 'research':
+                self.researches.append(row['id'])
+
+        raw = set(self.raw_items)
+        self.products = sorted(id for id, _ in self.items
+                               if id in self.producible and id not in raw)
+
+
+def make_request(group: str, ids: SeedIds, rand: random.Random) -> LoadRequest:
+    if group == 'catalog':
+        kind = rand.choice(['items', 'grouping', 'recipes', 'search'])
+        if kind == 'items':
+            return LoadRequest(group, '/api/v1/items', '/api/v1/items')
+        if kind == 'grouping':
+            return LoadRequest(group, '/api/v1/items', '/api/v1/items?grouping=1')
+        if kind == 'recipes':
+            page = rand.randrange(max(ids.recipe_count // 50, 1))
+            return LoadRequest(group, '/api/v1/recipes', f'/api/v1/recipes?page={page}')
+        _, name = rand.choice(ids.items)
+        query = quote(name[:rand.randint(1, min(len(name), 3))])
+        return LoadRequest(group, '/api/v1/search', f'/api/v1/search?q={query}')
+
+    if group == 'item':
+        item_id, _ = rand.choice(ids.items)
+        route = rand.choice(ITEM_ROUTES)
+        return LoadRequest(group, f'/api/v1/item/<string:item_id>/{route}',
+                           f'/api/v1/item/{quote(item_id)}/{route}')
+
+    if group == 'planner':
+        product = rand.choice(ids.products)
+        rate = rand.choice([10, 30, 60, 120])
+        url = (f'/api/v1/planner?products={quote(product)}:{rate}&tier=9'
+               f'&researches={quote(",".join(ids.researches))}'
+               f'&ingredients={quote(",".join(ids.raw_items))}')
+        return LoadRequest(group, '/api/v1/planner', url)
+
+    raise ValueError(f'unknown request group: {group}')
+
+
+def parse_mix(value: str) -> dict[str, float]:
+    mix = {}
+    for part in value.split(','):
+        name, _, weight = part.partition('=')
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+def make_requests(mix: dict[str, float], count: int, seed: int) -> list[LoadRequest]:
+    rand = random.Random(seed)
+    ids = SeedIds()
+    groups = rand.choices(list(mix), weights=list(mix.values()), k=count)
+    return [make_request(group, ids, rand) for group in groups]
+
+
+def make_sender(url: str | None):
+    """1スレッドで使う、リクエストを送る関数を作成します。ステータスコードを返します。"""
+    if url is None:
+        from app import app
+        client = app.test_client()
+        return lambda path: client.get(path).status_code
+
+    def send(path: str) -> int:
+        try:
+            with urllib.request.urlopen(url + path, timeout=120) as response:
+                response.read()
+                return response.status
+        except urllib.error.HTTPError as ex:
+            return ex.code
+    return send
+
+
+def percentile(samples: list[float], p: float) -> float:
+    samples = sorted(samples)
+    return samples[min(int(len(samples) * p / 100), len(samples) - 1)]
+
+
+def run(requests: list[LoadRequest], url: str | None, concurrency: int) -> dict:
+    samples: dict[str, list[float]] = {}
+    errors: dict[str, int] = {}
+    lock = threading.Lock()
+    position = iter(range(len(requests)))
+
+    def worker():
+        send = make_sender(url)
+        while True:
+            with lock:
+                index = next(position, None)
+            if index is None:
+                return
+            req = requests[index]
+            start = time.perf_counter()
+            status = send(req.url)
+            elapsed = time.perf_counter() - start
+            with lock:
+                samples.setdefault(req.route, []).append(elapsed)
+                if status >= 400:
+                    errors[req.route] = errors.get(req.route, 0) + 1
+
+    # アプリの読み込みやキャッシュの作成を計測に含めないように、1度ずつ実行しておきます。
+    warm = make_sender(url)
+    for req in {req.route: req for req in requests}.values():
+        warm(req.url)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    routes = {}
+    for route, values in sorted(samples.items()):
+        routes[route] = {
+            'count': len(values),
+            'errors': errors.get(route, 0),
+            'rps': len(values) / elapsed,
+            'p50': statistics.median(values) * 1000,
+            'p95': percentile(values, 95) * 1000,
+            'p99': percentile(values, 99) * 1000,
+        }
+    return {
+        'target': url or 'in-process',
+        'concurrency': concurrency,
+        'requests': len(requests),
+        'elapsed': elapsed,
+        'rps': len(requests) / elapsed,
+        'routes': routes,
+    }
+
+
+def print_result(result: dict, baseline: dict | None) -> list[tuple[str, float]]:
+    """結果を表示し、ベースラインと比べたp95の変化率(%)をルートごとに返します。"""
+    base_routes = (baseline or {}).get('routes', {})
+    print(f'{"route":58}{"count":>7}{"err":>5}{"req/s":>9}'
+          f'{"p50 ms":>9}{"p95 ms":>9}{"p99 ms":>9}' + ('  p95 vs base' if baseline else ''))
+
+    changes = []
+    for route, r in result['routes'].items():
+        line = (f'{route:58}{r["count"]:7}{r["errors"]:5}{r["rps"]:9.1f}'
+                f'{r["p50"]:9.2f}{r["p95"]:9.2f}{r["p99"]:9.2f}')
+        base = base_routes.get(route)
+        if base is not None and base['p95'] > 0:
+            change = (r['p95'] - base['p95']) / base['p95'] * 100
+            changes.append((route, change))
+            line += f'  {change:+10.1f}%'
+        print(line)
+    print(f'total: {result["requests"]} requests in {result["elapsed"]:.2f} s '
+          f'({result["rps"]:.1f} req/s)')
+    return changes
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', help='計測するサーバー。省略時はプロセス内で実行します。')
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help=f'リクエストの種類と比率 (デフォルト: {DEFAULT_MIX})')
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='結果のJSONを書き込むファイル')
+    parser.add_argument('--baseline', help='比較する結果のJSONファイル')
+    parser.add_argument('--max-regression', type=float,
+                        help='p95の悪化がこの割合(%%)を超えたら終了コード1を返します。')
+    args = parser.parse_args()
+
+    requests = make_requests(parse_mix(args.mix), args.requests, args.seed)
+    result = run(requests, args.url.rstrip('/') if args.url else None, args.concurrency)
+    result['mix'] = args.mix
+    result['seed'] = args.seed
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as fp:
+            baseline = json.load(fp)
+    changes = print_result(result, baseline)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as fp:
+            json.dump(result, fp, indent=2, sort_keys=True)
+
+    if args.max_regression is not None:
+        regressed = [(route, change) for route, change in changes
+                     if change > args.max_regression]
+        for route, change in regressed:
+            print(f'regression: {route} p95 {change:+.1f}%', file=sys.stderr)
+        if regressed:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+#!/usr/bin/python
+"""プランナーの計算が重なっている間の、素材一覧の応答時間を計測します。
+
+    python benchmarks/planner_load.py [--mode wsgi|asgi ...] [--workers N]
+                                      [--planners N] [--clients N] [--duration SEC]
+
+モードごとにサーバーを別プロセスで起動し、プランナーを呼び続けるスレッドと
+/api/v1/items を呼び続けるスレッドから同時にリクエストを送ります。
+  wsgi: gunicorn (同期ワーカー) で app:app を実行します。
+  asgi: uvicorn で asgi:application を実行し、プランナーはプロセスプールで計算します。
+
+gunicornはこのベンチマークだけで使うため、Pipfileのdev-packagesに入れています。
+wsgiモードの前に pipenv install --dev でインストールしてください。
+"""
+import argparse
+import importlib.util
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CATALOG_URL = '/api/v1/items'
+PLANNER_URL = ('/api/v1/planner?products=Computer:10&ingredients=Copper_Ore,Crude_Oil,Water'
+               '&tier=9')
+
+
+def server_command(mode: str, port: int, workers: int) -> list[str]:
+    if mode == 'wsgi':
+        return [sys.executable, '-m', 'gunicorn', '-w', str(workers),
+                '-b', f'127.0.0.1:{port}', 'app:app']
+    return [sys.executable, '-m', 'uvicorn', 'asgi:application',
+            '--port', str(port), '--log-level', 'warning']
+
+
+def wait_ready(base: str, timeout: float = 30) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(base + '/', timeout=1).read()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f'server did not start: {base}')
+
+
+def request(url: str) -> int:
+    try:
+        with urllib.request.urlopen(url, timeout=120) as response:
+            response.read()
+            return response.status
+    except urllib.error.HTTPError as ex:
+        return ex.code
+
+
+def percentile(samples: list[float], p: float) -> float:
+    samples = sorted(samples)
+    return samples[min(int(len(samples) * p / 100), len(samples) - 1)]
+
+
+def measure(mode: str, args: argparse.Namespace) -> dict:
+    port = args.port
+    base = f'http://127.0.0.1:{port}'
+    env = dict(os.environ, SF_STARTUP_MODE='lazy', SF_PLANNER_WORKERS=str(args.workers),
+               PYTHONPATH=BACKEND_DIR)
+    server = subprocess.Popen(server_command(mode, port, args.workers), cwd=BACKEND_DIR,
+                              env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_ready(base)
+        # キャッシュとワーカーの準備を済ませておきます。
+        request(base + CATALOG_URL)
+        request(base + PLANNER_URL)
+
+        stop = threading.Event()
+        latencies = []
+        planner_statuses = []
+
+        def planner_loop():
+            while not stop.is_set():
+                planner_statuses.append(request(base + PLANNER_URL))
+
+        def catalog_loop():
+            while not stop.is_set():
+                start = time.perf_counter()
+                request(base + CATALOG_URL)
+                latencies.append(time.perf_counter() - start)
+
+        threads = ([threading.Thread(target=planner_loop) for _ in range(args.planners)]
+                   + [threading.Thread(target=catalog_loop) for _ in range(args.clients)])
+        for thread in threads:
+            thread.start()
+        time.sleep(args.duration)
+        stop.set()
+        for thread in threads:
+            thread.join()
+    finally:
+        server.terminate()
+        server.wait()
+
+    return {
+        'catalog': len(latencies),
+        'p50': statistics.median(latencies) * 1000,
+        'p99': percentile(latencies, 99) * 1000,
+        'planner_ok': planner_statuses.count(200),
+        'planner_503': planner_statuses.count(503),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mode', action='append', choices=['wsgi', 'asgi'])
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--planners', type=int, default=4)
+    parser.add_argument('--clients', type=int, default=4)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+    modes = args.mode or ['wsgi', 'asgi']
+    if 'wsgi' in modes and importlib.util.find_spec('gunicorn') is None:
+        parser.error('wsgi mode requires gunicorn (pipenv install --dev)')
+
+    print(f'{"mode":6}{"catalog":>10}{"p50 ms":>10}{"p99 ms":>10}'
+          f'{"planner":>10}{"503":>8}')
+    for mode in modes:
+        r = measure(mode, args)
+        print(f'{mode:6}{r["catalog"]:10}{r["p50"]:10.2f}{r["p99"]:10.2f}'
+              f'{r["planner_ok"]:10}{r["planner_503"]:8}')
+
+
+if __name__ == '__main__':
+    main()
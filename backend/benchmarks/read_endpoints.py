@@ -0,0 +1,69 @@
+#!/usr/bin/python
+"""DB接続のプロファイルごとに、読み取り系エンドポイントの応答時間を計測します。
+
+    python benchmarks/read_endpoints.py [--repeat N] [--profile default|readonly ...]
+
+プロファイルごとに別プロセスでアプリを起動し、Flaskのテストクライアントで計測します。
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ENDPOINTS = [
+    '/api/v1/items',
+    '/api/v1/recipes?count=50',
+    '/api/v1/item/Iron_Plate/recipes/producing',
+    '/api/v1/item/Iron_Plate/recipes/using_for_item',
+    '/api/v1/item/Iron_Plate/recipes/using_for_building',
+    '/api/v1/item/Iron_Plate/milestones',
+    '/api/v1/item/Iron_Plate/researches',
+]
+
+CHILD_SCRIPT = '''
+import json, statistics, sys, time
+from app import app
+endpoints, repeat = json.loads(sys.argv[1]), int(sys.argv[2])
+client = app.test_client()
+result = {}
+for url in endpoints:
+    client.get(url)
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        client.get(url)
+        samples.append(time.perf_counter() - start)
+    result[url] = statistics.median(samples) * 1000
+print(json.dumps(result))
+'''
+
+
+def measure(profile: str, repeat: int) -> dict[str, float]:
+    env = dict(os.environ, SF_DB_PROFILE=profile, SF_STARTUP_MODE='lazy',
+               PYTHONPATH=BACKEND_DIR)
+    result = subprocess.run([sys.executable, '-c', CHILD_SCRIPT,
+                             json.dumps(ENDPOINTS), str(repeat)],
+                            cwd=BACKEND_DIR, env=env, capture_output=True,
+                            text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--profile', action='append', choices=['default', 'readonly'])
+    args = parser.parse_args()
+    profiles = args.profile or ['default', 'readonly']
+
+    results = {profile: measure(profile, args.repeat) for profile in profiles}
+
+    print(f'{"endpoint (median ms)":52}' + ''.join(f'{p:>10}' for p in profiles))
+    for url in ENDPOINTS:
+        print(f'{url:52}' + ''.join(f'{results[p][url]:10.2f}' for p in profiles))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+#!/usr/bin/python
+"""名前検索のインデックス作成時間と、クエリの長さごとの検索時間を計測します。
+
+    python benchmarks/search_index.py [--repeat N]
+"""
+import argparse
+import time
+
+from app import app, datasets
+from catalog import get_catalog
+from search import build_search_index
+
+QUERIES = ['鉄', '鉄板', '鉄鉱石', '鉄鉱石（石灰岩）', '強化鉄板', 'iron', 'iron plate',
+           'reinforced iron plate', 'モジュラー', 'コンピューター', 'x', 'zzzz']
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=1000)
+    args = parser.parse_args()
+
+    catalog = get_catalog(datasets.current)
+    start = time.perf_counter()
+    index = build_search_index(catalog)
+    print(f'build: {(time.perf_counter() - start) * 1000:.2f} ms '
+          f'({len(index.entries)} entries, {len(index.postings)} grams)')
+
+    print(f'{"query":28} {"hits":>5} {"us/query":>10}  top')
+    for query in QUERIES:
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            result = index.search(query)
+        elapsed = (time.perf_counter() - start) / args.repeat * 1e6
+        top = result[0].name if result else '-'
+        print(f'{query:28} {len(result):5} {elapsed:10.1f}  {top}')
+
+
+if __name__ == '__main__':
+    main()
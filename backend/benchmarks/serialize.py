@@ -0,0 +1,88 @@
+#!/usr/bin/python
+"""全カタログのシリアライズ時間を計測します。
+
+    python benchmarks/serialize.py [--repeat N]
+
+比較のため、モデルクラスごとの変換関数を作る前の実装(legacy_model_to_dict)も計測します。
+JSONは、現在のプロバイダ(SF_JSON_PROVIDER)に加えて、orjsonがあればorjsonでも計測します。
+"""
+import argparse
+import datetime
+import json
+import time
+from typing import Callable
+
+from app import app
+from jsonprovider import OrjsonProvider, orjson
+from models import db, model_to_dict, to_camel_case, Item, Building, Recipe, RecipeItem, \
+                   Condition, ConditionItem
+
+
+def legacy_model_to_dict(model) -> dict:
+    """以前のmodel_to_dictです。行ごとにカラムを調べ、キー名を変換します。"""
+    def convert(value: any) -> any:
+        match type(value):
+            case datetime.timedelta:
+                return value.total_seconds()
+        return value
+
+    result = {to_camel_case(column.name): convert(getattr(model, column.name))
+              for column in model.__table__.columns}
+
+    link = getattr(model, 'wiki_link', None)
+    if link:
+        result['wikiLink'] = link
+    return result
+
+
+def measure(func: Callable[[], any], repeat: int) -> float:
+    """funcを繰り返し実行し、最短の実行時間[ms]を返します。"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    with app.app_context():
+        # DBアクセスの時間を含めないよう、すべての行を先に読み込んでおきます。
+        rows = []
+        for model in (Item, Building, Recipe, RecipeItem, Condition, ConditionItem):
+            rows.extend(db.session.query(model).all())
+
+        def columns_only():
+            return [model_to_dict(row) for row in rows]
+
+        def legacy_columns_only():
+            return [legacy_model_to_dict(row) for row in rows]
+
+        payload = columns_only()
+        assert payload == legacy_columns_only()
+
+        results = {
+            'rows': len(rows),
+            'legacy_to_dict_ms': measure(legacy_columns_only, args.repeat),
+            'model_to_dict_ms': measure(columns_only, args.repeat),
+            'json_stdlib_ms': measure(lambda: json.dumps(payload), args.repeat),
+            'json_provider_ms': measure(lambda: app.json.dumps(payload), args.repeat),
+            'json_provider': type(app.json).__name__,
+        }
+        if orjson is not None:
+            provider = OrjsonProvider(app)
+            results['json_orjson_ms'] = measure(lambda: provider.dumps(payload), args.repeat)
+
+    for key, value in results.items():
+        if isinstance(value, float):
+            print(f'{key:20}: {value:8.2f}')
+        else:
+            print(f'{key:20}: {value}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+"""データセットの内容を、リクエストをまたいで使うためのメモリ上のグラフとして保持します。
+
+カタログはデータセットごとに1度だけ作成され、Dataset.cachedに保持されます。
+"""
+from collections import namedtuple
+from typing import Iterable
+from sqlalchemy import Engine, select
+
+from dataset import Dataset
+from models import Item, Building, Recipe, RecipeItem, Condition, ConditionItem
+
+# このカテゴリの素材は採掘などで手に入る基本資源として扱い、レシピを辿りません。
+RAW_CATEGORIES = ('鉱石類',)
+
+ItemNode = namedtuple('ItemNode', ['id', 'name', 'index', 'kind', 'category'])
+BuildingNode = namedtuple('BuildingNode', ['id', 'name', 'index', 'category', 'power'])
+Amount = namedtuple('Amount', ['item_id', 'amount', 'minute'])
+RecipeNode = namedtuple('RecipeNode', ['id', 'name', 'index', 'alternate', 'power',
+                                       'condition_id', 'building_id',
+                                       'ingredients', 'products'])
+ConditionNode = namedtuple('ConditionNode', ['id', 'kind', 'name', 'index',
+                                             'tier', 'category', 'time', 'items'])
+
+
+class Catalog:
+    def __init__(self, items: list[ItemNode], buildings: list[BuildingNode],
+                 recipes: list[RecipeNode], conditions: list[ConditionNode]):
+        self.items = {item.id: item for item in items}
+        self.buildings = {building.id: building for building in buildings}
+        self.recipes = {recipe.id: recipe for recipe in recipes}
+        self.conditions = {cond.id: cond for cond in conditions}
+
+        # 素材ごとの、それを生産／消費するレシピ
+        self.producing: dict[str, list[RecipeNode]] = {}
+        self.consuming: dict[str, list[RecipeNode]] = {}
+        for recipe in recipes:
+            for prod in recipe.products:
+                self.producing.setdefault(prod.item_id, []).append(recipe)
+            for ing in recipe.ingredients:
+                self.consuming.setdefault(ing.item_id, []).append(recipe)
+
+        # 素材ごとの標準のレシピ
+        #   主生産物がその素材である通常レシピのうち、IDが素材と同じもの、
+        #   なければ最初のものを使います。
+        self.default_recipes: dict[str, RecipeNode] = {}
+        for recipe in recipes:
+            if not recipe.products or recipe.alternate:
+                continue
+            item_id = recipe.products[0].item_id
+            if item_id not in self.items or self.is_raw_category(item_id):
+                continue
+            current = self.default_recipes.get(item_id)
+            if current is None or (recipe.id == item_id and current.id != item_id):
+                self.default_recipes[item_id] = recipe
+
+    def is_raw_category(self, item_id: str) -> bool:
+        item = self.items.get(item_id)
+        return item is not None and item.category in RAW_CATEGORIES
+
+    def choose_recipes(self, recipe_ids: Iterable[str] = ()) -> dict[str, RecipeNode]:
+        """素材ごとに使うレシピを決めます。
+
+        recipe_idsで指定したレシピ(代替レシピなど)は、その主生産物のレシピとして
+        標準のレシピより優先されます。レシピがない素材は基本資源として扱います。
+        """
+        choice = dict(self.default_recipes)
+        # 同じ素材のレシピが複数ある場合は、順番が先のものを使います。
+        selected = sorted((self.recipes[id] for id in set(recipe_ids) if id in self.recipes),
+                          key=lambda r: r.index, reverse=True)
+        for recipe in selected:
+            if recipe.products and not self.is_raw_category(recipe.products[0].item_id):
+                choice[recipe.products[0].item_id] = recipe
+        return choice
+
+
+def load_catalog(engine: Engine) -> Catalog:
+    """データセットのDBからカタログを作成します。"""
+    with engine.connect() as conn:
+        items = [ItemNode(*row) for row in conn.execute(
+            select(Item.id, Item.name, Item.index, Item.kind, Item.category)
+            .order_by(Item.index))]
+
+        buildings = [BuildingNode(*row) for row in conn.execute(
+            select(Building.id, Building.name, Building.index,
+                   Building.category, Building.power)
+            .order_by(Building.index))]
+        building_powers = {building.id: building.power for building in buildings}
+
+        recipe_items = {}
+        for recipe_id, role, item_id, amount, minute in conn.execute(
+                select(RecipeItem.recipe_id, RecipeItem.role, RecipeItem.item_id,
+                       RecipeItem.amount, RecipeItem.minute)
+                .order_by(RecipeItem.index)):
+            recipe_items.setdefault((recipe_id, role), []).append(
+                Amount(item_id, amount, minute))
+
+        recipes = []
+        for row in conn.execute(
+                select(Recipe.id, Recipe.name, Recipe.index, Recipe.alternate,
+                       Recipe.power, Recipe.condition_id, Recipe.building_id)
+                .order_by(Recipe.index)):
+            recipe_id, name, index, alternate, power, condition_id, building_id = row
+            recipes.append(RecipeNode(
+                recipe_id, name, index, alternate,
+                # Recipe.get_power()と同じく、レシピに電力がなければ施設の電力を使います。
+                power or building_powers.get(building_id),
+                condition_id, building_id,
+                tuple(recipe_items.get((recipe_id, 'ingredient'), ())),
+                tuple(recipe_items.get((recipe_id, 'product'), ()))))
+
+        condition_items = {}
+        for condition_id, item_id, amount in conn.execute(
+                select(ConditionItem.condition_id, ConditionItem.item_id,
+                       ConditionItem.amount)
+                .order_by(ConditionItem.index)):
+            condition_items.setdefault(condition_id, []).append(
+                Amount(item_id, amount, None))
+
+        conditions = [ConditionNode(*row[:6], row[6].total_seconds(),
+                                    tuple(condition_items.get(row[0], ())))
+                      for row in conn.execute(
+                          select(Condition.id, Condition.kind, Condition.name,
+                                 Condition.index, Condition.tier,
+                                 Condition.category, Condition.time)
+                          .order_by(Condition.kind, Condition.index))]
+
+    return Catalog(items, buildings, recipes, conditions)
+
+
+def get_catalog(dataset: Dataset) -> Catalog:
+    return dataset.cached('catalog', lambda: load_catalog(dataset.engine))
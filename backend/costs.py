@@ -0,0 +1,200 @@
+"""すべての素材について、1分あたり1個を作るのに必要な基本資源と電力を計算します。
+
+素材ごとに1つのレシピを選ぶと、素材×レシピの行列は正方行列になります。
+A の j 列目を「素材 j を1個作るのに消費する素材の量」とすると (I - A) X = I を
+一度解くだけで、X の i 列目が素材 i を1個作るために各素材を作る量になります。
+基本資源の素材は A の列が0で、X の値がそのまま必要な資源の量になります。
+副産物は利用しないものとして計算します。また、梱包と開封のように循環するレシピの辺は
+生産ツリーと同じく需要を伝播させないため、I - A は常に正則になります。
+"""
+from collections import namedtuple
+from typing import Callable, Iterable
+import numpy as np
+
+from catalog import Catalog, RecipeNode, get_catalog
+from dataset import Dataset
+from production import recipe_profile
+
+# これより小さい値は0として扱います。
+EPSILON = 1e-9
+
+# マイルストーン/研究の達成に必要な素材、基本資源、時間(秒)の合計
+UnlockCost = namedtuple('UnlockCost', ['items', 'raw', 'time'])
+
+
+def cycle_edges(choice: dict[str, RecipeNode]) -> set[tuple[str, str]]:
+    """選んだレシピの素材のグラフで、循環を作る (生産物, 材料) の辺を返します。"""
+    cycles = set()
+    state = {}
+
+    def visit(item_id: str):
+        state[item_id] = 'visiting'
+        recipe = choice.get(item_id)
+        for ing in recipe.ingredients if recipe is not None else ():
+            child_state = state.get(ing.item_id)
+            if child_state == 'visiting':
+                cycles.add((item_id, ing.item_id))
+            elif child_state is None:
+                visit(ing.item_id)
+        state[item_id] = 'done'
+
+    for item_id in choice:
+        if item_id not in state:
+            visit(item_id)
+    return cycles
+
+
+def build_cost_table(catalog: Catalog, profile: frozenset[str]) -> dict[str, dict]:
+    choice = catalog.choose_recipes(profile)
+    item_ids = list(catalog.items)
+    index = {item_id: i for i, item_id in enumerate(item_ids)}
+    n = len(item_ids)
+    cycles = cycle_edges(choice)
+
+    # 素材 j を1個作るのに必要な、素材ごとの量・施設数・電力
+    consumption = np.zeros((n, n))
+    buildings = np.zeros(n)
+    powers = np.zeros(n)
+    for j, item_id in enumerate(item_ids):
+        recipe = choice.get(item_id)
+        prod = None
+        if recipe is not None:
+            prod = next((p for p in recipe.products if p.item_id == item_id), None)
+        if prod is None or not prod.minute:
+            continue
+
+        for ing in recipe.ingredients:
+            if ing.item_id in index and (item_id, ing.item_id) not in cycles:
+                consumption[index[ing.item_id], j] += ing.minute / prod.minute
+        buildings[j] = 1 / prod.minute
+        powers[j] = (recipe.power or 0) / prod.minute
+
+    is_raw = buildings == 0
+    matrix = np.eye(n) - consumption
+
+    solution = np.linalg.solve(matrix, np.eye(n))
+
+    raw_rows = np.flatnonzero(is_raw)
+    building_counts = buildings @ solution
+    total_powers = powers @ solution
+
+    table = {}
+    for i, item_id in enumerate(item_ids):
+        column = solution[:, i]
+        table[item_id] = {
+            'raw': {item_ids[j]: round(float(column[j]), 6) for j in raw_rows
+                    if abs(column[j]) > EPSILON},
+            'power': round(float(total_powers[i]), 6),
+            'buildings': round(float(building_counts[i]), 6),
+        }
+    return table
+
+
+def get_cost_table(dataset: Dataset, recipe_ids: Iterable[str] = ()) -> dict[str, dict]:
+    catalog = get_catalog(dataset)
+    profile = recipe_profile(catalog, recipe_ids)
+    return dataset.cached_profile(('cost_table', profile),
+                                  lambda: build_cost_table(catalog, profile))
+
+
+def add_costs(*costs: UnlockCost) -> UnlockCost:
+    items = {}
+    raw = {}
+    for cost in costs:
+        for id, amount in cost.items.items():
+            items[id] = items.get(id, 0) + amount
+        for id, amount in cost.raw.items():
+            raw[id] = raw.get(id, 0) + amount
+    return UnlockCost(items, raw, sum(cost.time for cost in costs))
+
+
+def unlock_subtotals(dataset: Dataset, profile: frozenset[str]) -> dict[tuple, UnlockCost]:
+    """レシピの組み合わせごとの、マイルストーン/研究とティアの費用のメモです。
+
+    小計は組み合わせごとに百数十個あるため、まとめて1つのキャッシュの項目にして、
+    生産ツリーや費用表をLRUから押し出さないようにします。
+    """
+    return dataset.cached_profile(('unlock_subtotals', profile), dict)
+
+
+def memoize_subtotal(dataset: Dataset, profile: frozenset[str], key: tuple,
+                     build: Callable[[], UnlockCost]) -> UnlockCost:
+    subtotals = unlock_subtotals(dataset, profile)
+    cost = subtotals.get(key)
+    if cost is None:
+        cost = subtotals[key] = build()
+    return cost
+
+
+def condition_cost(dataset: Dataset, condition_id: str,
+                   profile: frozenset[str]) -> UnlockCost:
+    """1つのマイルストーン/研究の費用です。レシピの組み合わせごとにメモ化します。"""
+    def build() -> UnlockCost:
+        cond = get_catalog(dataset).conditions[condition_id]
+        table = get_cost_table(dataset, profile)
+        items = {}
+        raw = {}
+        for amount in cond.items:
+            items[amount.item_id] = items.get(amount.item_id, 0) + amount.amount
+            for id, value in table.get(amount.item_id, {}).get('raw', {}).items():
+                raw[id] = raw.get(id, 0) + value * amount.amount
+        return UnlockCost(items, raw, cond.time)
+
+    return memoize_subtotal(dataset, profile, ('condition', condition_id), build)
+
+
+def tier_cost(dataset: Dataset, tier: int, profile: frozenset[str]) -> UnlockCost:
+    """ティア0からtierまでのマイルストーンをすべて達成する費用です。
+
+    1つ前のティアまでの小計に、そのティアのマイルストーンを足して求めます。
+    """
+    def build() -> UnlockCost:
+        milestones = [cond for cond in get_catalog(dataset).conditions.values()
+                      if cond.kind == 'milestone' and cond.tier == tier]
+        costs = [condition_cost(dataset, cond.id, profile) for cond in milestones]
+        if tier > 0:
+            costs.append(tier_cost(dataset, tier - 1, profile))
+        return add_costs(*costs)
+
+    return memoize_subtotal(dataset, profile, ('tier', tier), build)
+
+
+def get_unlock_cost(dataset: Dataset, tier: int | None = None,
+                    condition_ids: Iterable[str] = (),
+                    recipe_ids: Iterable[str] = ()) -> dict:
+    """指定したティアまでと、指定したマイルストーン/研究を達成する費用の合計を返します。
+
+    基本資源は、素材をrecipe_idsのレシピの選択で作るとした場合の量です。
+    """
+    catalog = get_catalog(dataset)
+    profile = recipe_profile(catalog, recipe_ids)
+
+    costs = []
+    max_tier = None
+    if tier is not None:
+        tiers = [cond.tier for cond in catalog.conditions.values()
+                 if cond.kind == 'milestone' and cond.tier is not None]
+        max_tier = min(tier, max(tiers, default=0))
+        costs.append(tier_cost(dataset, max_tier, profile))
+
+    conditions = []
+    for id in dict.fromkeys(condition_ids):
+        cond = catalog.conditions.get(id)
+        if cond is None:
+            continue
+        # ティアに含まれるマイルストーンは二重に数えません。
+        if (cond.kind == 'milestone' and max_tier is not None
+                and cond.tier is not None and cond.tier <= max_tier):
+            continue
+        conditions.append(id)
+        costs.append(condition_cost(dataset, id, profile))
+
+    total = add_costs(*costs)
+    return {
+        'tier': max_tier,
+        'conditions': conditions,
+        'items': {id: round(value, 6) for id, value in total.items.items()},
+        'raw': {id: round(value, 6) for id, value in total.raw.items()
+                if abs(value) > EPSILON},
+        'time': total.time,
+    }
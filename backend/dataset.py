@@ -0,0 +1,361 @@
+#!/usr/bin/python
+"""seeddata/*.yaml からビルド済みのデータセット(SQLiteファイル)を作成します。
+
+    python dataset.py [--output satisfactory.db] [--check] [--workers N]
+
+データセットにはシードデータと生産計画を計算するコード(PLAN_SOURCES)から計算した
+バージョンが書き込まれ、どちらかが更新されると古いデータセットとして検出されます。
+
+サーバーはDatasetManagerを通してデータセットを使い、
+プロセスを再起動せずに新しいデータセットへ入れ替えることができます。
+"""
+import argparse
+import glob
+import hashlib
+import logging
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from functools import cached_property
+from typing import Any, Callable, Hashable
+from sqlalchemy import create_engine, select
+
+from dbprofile import engine_options
+from models import db, DatasetInfo, PrecomputedPlan
+
+BASE_DIR = os.path.abspath(os.path.dirname(__file__))
+SEEDDATA_DIR = os.path.join(BASE_DIR, 'seeddata')
+DEFAULT_DATASET_PATH = os.path.join(BASE_DIR, 'satisfactory.db')
+
+# テーブル構成などを変えた場合はこの値を増やし、既存のデータセットを無効にします。
+#   2: 計算済みの生産計画(precomputed_plan)を追加
+DATASET_FORMAT = 2
+
+# 計算済みの生産計画の内容を決めるコードです。変更するとデータセットを作り直します。
+PLAN_SOURCES = ('linerprog.py', 'precompute.py')
+
+
+def seeddata_hash(seeddata_dir: str = SEEDDATA_DIR) -> str | None:
+    """シードデータとPLAN_SOURCESの内容から、データセットのバージョンを計算します。
+
+    シードデータがない環境(Lambdaなど)ではNoneを返します。
+    """
+    paths = sorted(glob.glob(os.path.join(seeddata_dir, '*.yaml')))
+    if not paths:
+        return None
+
+    sha = hashlib.sha256(f'format:{DATASET_FORMAT}\n'.encode('utf-8'))
+    for path in paths:
+        sha.update(os.path.basename(path).encode('utf-8') + b'\0')
+        with open(path, 'rb') as fp:
+            sha.update(fp.read())
+        sha.update(b'\0')
+    for name in PLAN_SOURCES:
+        sha.update(name.encode('utf-8') + b'\0')
+        with open(os.path.join(BASE_DIR, name), 'rb') as fp:
+            sha.update(fp.read())
+        sha.update(b'\0')
+    return sha.hexdigest()[:16]
+
+
+def read_dataset_version(path: str) -> str | None:
+    """データセットに書き込まれたバージョンを取得します。"""
+    if not os.path.exists(path):
+        return None
+
+    try:
+        conn = sqlite3.connect(path)
+        try:
+            row = conn.execute("SELECT value FROM dataset_info WHERE key = 'version'").fetchone()
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return None
+    return row[0] if row else None
+
+
+def has_precomputed_plans(path: str) -> bool:
+    """データセットに計算済みの生産計画(precomputed_plan)があるかを確認します。"""
+    if not os.path.exists(path):
+        return False
+
+    try:
+        conn = sqlite3.connect(path)
+        try:
+            row = conn.execute('SELECT 1 FROM precomputed_plan LIMIT 1').fetchone()
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return False
+    return row is not None
+
+
+def is_stale(path: str, precompute: bool = False) -> bool:
+    """データセットがないか、シードデータと内容が異なるかを確認します。
+
+    precomputeがTrueの場合は、生産計画を計算せずに作成したデータセットも古いものとします。
+    """
+    expected = seeddata_hash()
+    if expected is None:
+        return not os.path.exists(path)
+    if read_dataset_version(path) != expected:
+        return True
+    return precompute and not has_precomputed_plans(path)
+
+
+def build_dataset(path: str = DEFAULT_DATASET_PATH, validate: bool = False,
+                  workers: int | None = None, precompute: bool = True) -> str:
+    """シードデータからデータセットを作成し、そのバージョンを返します。
+
+    一時ファイルに書き込んでから置き換えるため、
+    作成中のデータセットが読み込まれることはありません。
+    workersは生産計画の計算(precompute.py)を行うプロセス数です。
+    precomputeがFalseの場合は生産計画を計算せず、最初の要求時に素材ごとに計算します。
+    """
+    from seeddata import insert_seeddata
+    from precompute import precompute_plans
+
+    version = seeddata_hash()
+    if version is None:
+        raise FileNotFoundError(f'seeddata is not found in {SEEDDATA_DIR}')
+
+    fd, tmp_path = tempfile.mkstemp(suffix='.db', dir=os.path.dirname(os.path.abspath(path)))
+    os.close(fd)
+    try:
+        engine = create_engine(f'sqlite:///{tmp_path}')
+        db.metadata.create_all(engine)
+
+        with engine.connect() as conn:
+            # 失敗時は一時ファイルごと捨てるため、ジャーナルや同期は不要です。
+            conn.exec_driver_sql('PRAGMA journal_mode = OFF')
+            conn.exec_driver_sql('PRAGMA synchronous = OFF')
+            conn.commit()
+
+            # すべてのテーブルを1つのトランザクションで挿入します。
+            start = time.perf_counter()
+            count = insert_seeddata(conn, validate)
+            conn.execute(DatasetInfo.__table__.insert(),
+                         [{'key': 'version', 'value': version}])
+            conn.commit()
+            elapsed = time.perf_counter() - start
+
+            # 挿入したシードデータを使って、生産計画を計算します。
+            plan_start = time.perf_counter()
+            plans = precompute_plans(tmp_path, workers) if precompute else []
+            if plans:
+                conn.execute(PrecomputedPlan.__table__.insert(), plans)
+                conn.commit()
+            plan_elapsed = time.perf_counter() - plan_start
+
+            conn.exec_driver_sql('VACUUM')
+            conn.commit()
+        engine.dispose()
+
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+    logging.info('dataset %s is built: %s (%d rows in %.3f sec, %.0f rows/sec)',
+                 version, path, count, elapsed, count / elapsed)
+    if precompute:
+        logging.info('%d plans are precomputed in %.3f sec', len(plans), plan_elapsed)
+    else:
+        logging.info('plans are not precomputed, they are solved on the first request')
+    return version
+
+
+class LRUCache:
+    """件数に上限があるキャッシュです。超えた場合は使われていない順に削除します。"""
+
+    def __init__(self, size: int):
+        self.size = size
+        self._values: OrderedDict[Hashable, Any] = OrderedDict()
+
+    def get(self, key: Hashable) -> tuple[bool, Any]:
+        if key not in self._values:
+            return False, None
+        self._values.move_to_end(key)
+        return True, self._values[key]
+
+    def put(self, key: Hashable, value: Any) -> None:
+        self._values[key] = value
+        while len(self._values) > self.size:
+            self._values.popitem(last=False)
+
+
+class Dataset:
+    """読み込み済みのデータセットです。
+
+    インデックスやレスポンスなど、データセットから計算した値はこのオブジェクトに
+    キャッシュされるため、異なるバージョンの値が混ざることはありません。
+
+    キャッシュは値の種類ごとに分けて持ちます。
+      cached         : カタログや検索用のインデックスなど。キーの種類が決まっているため削除しません。
+      cached_profile : レシピの組み合わせごとの生産ツリーや費用表など。LRUで保持します。
+      cached_response: クエリパラメータごとのレスポンス。LRUで保持します。
+    レスポンスがいくら増えても、インデックスが削除されることはありません。
+    """
+
+    def __init__(self, path: str, profile: str = 'default',
+                 profile_cache_size: int = 256, response_cache_size: int = 1024):
+        self.path = path
+        self.engine = create_engine(f'sqlite:///{path}', **engine_options(profile, path))
+        self._indexes: dict[Hashable, Any] = {}
+        self._profiles = LRUCache(profile_cache_size)
+        self._responses = LRUCache(response_cache_size)
+        self._lock = threading.Lock()
+        # キャッシュの種類(キーの先頭の要素)ごとの [ヒット数, ミス数]
+        self.cache_stats: dict[str, list[int]] = {}
+
+    @cached_property
+    def version(self) -> str:
+        """dataset_infoに書かれたバージョン。ない場合はファイルのハッシュ値を使います。"""
+        with self.engine.connect() as conn:
+            try:
+                version = conn.execute(select(DatasetInfo.value)
+                                       .where(DatasetInfo.key == 'version')).scalar()
+            except Exception:
+                version = None
+        if version is not None:
+            return version
+
+        with open(self.path, 'rb') as fp:
+            return 'file-' + hashlib.sha256(fp.read()).hexdigest()[:16]
+
+    def cached(self, key: Hashable, factory: Callable[[], Any]) -> Any:
+        """データセットごとのインデックスを返します。なければfactoryで作成し、削除せずに保持します。"""
+        def get(key: Hashable) -> tuple[bool, Any]:
+            return key in self._indexes, self._indexes.get(key)
+
+        return self._lookup(get, self._indexes.__setitem__, key, factory)
+
+    def cached_profile(self, key: Hashable, factory: Callable[[], Any]) -> Any:
+        """レシピの組み合わせごとの値を返します。なければfactoryで作成し、LRUで保持します。"""
+        return self._lookup(self._profiles.get, self._profiles.put, key, factory)
+
+    def cached_response(self, key: Hashable, factory: Callable[[], Any]) -> Any:
+        """レスポンスを返します。なければfactoryで作成し、LRUで保持します。"""
+        return self._lookup(self._responses.get, self._responses.put, key, factory)
+
+    def _lookup(self, get: Callable[[Hashable], tuple[bool, Any]],
+                put: Callable[[Hashable, Any], None],
+                key: Hashable, factory: Callable[[], Any]) -> Any:
+        name = str(key[0] if isinstance(key, tuple) else key)
+        with self._lock:
+            stats = self.cache_stats.setdefault(name, [0, 0])
+            found, value = get(key)
+            if found:
+                stats[0] += 1
+                return value
+            stats[1] += 1
+
+        value = factory()
+        with self._lock:
+            put(key, value)
+        return value
+
+    def dispose(self) -> None:
+        """使っていない接続を閉じます。使用中の接続は返却時に閉じられます。"""
+        self.engine.dispose()
+
+
+class DatasetManager:
+    """現在のデータセットを管理し、新しいデータセットとの入れ替えを行います。
+
+    入れ替えは参照の差し替えのみで行われます。リクエストは開始時にcurrentを
+    取得して使い続けるため、処理中のリクエストが別のバージョンを見ることはありません。
+    新しいデータセットは、使用中のものとは別のファイルに作成してください。
+    """
+
+    def __init__(self, profile: str = 'default'):
+        self.profile = profile
+        # 入れ替え前に呼ばれ、インデックスなどを事前に作成します。
+        self.warmers: list[Callable[[Dataset], None]] = []
+        self.last_error: str | None = None
+        self._current: Dataset | None = None
+        self._lock = threading.Lock()
+        self._loading: threading.Thread | None = None
+
+    @property
+    def current(self) -> Dataset:
+        return self._current
+
+    def open(self, path: str) -> Dataset:
+        """データセットをすぐに現在のものとして設定します。起動時に使います。"""
+        return self._swap(Dataset(path, self.profile))
+
+    def load(self, path: str) -> Dataset:
+        """データセットを読み込んで準備し、完了後に現在のものと入れ替えます。"""
+        dataset = Dataset(path, self.profile)
+        logging.info('loading dataset %s (%s)', dataset.version, path)
+        for warm in self.warmers:
+            warm(dataset)
+        return self._swap(dataset)
+
+    def load_async(self, path: str) -> bool:
+        """バックグラウンドでloadを行います。読み込み中の場合はFalseを返します。"""
+        def run():
+            try:
+                self.load(path)
+                self.last_error = None
+            except Exception as ex:
+                logging.exception('failed to load dataset %s', path)
+                self.last_error = str(ex)
+
+        with self._lock:
+            if self._loading is not None and self._loading.is_alive():
+                return False
+            self._loading = threading.Thread(target=run, name='dataset-loader', daemon=True)
+            self._loading.start()
+        return True
+
+    def status(self) -> dict:
+        dataset = self._current
+        loading = self._loading
+        return {
+            'version': dataset.version if dataset is not None else None,
+            'path': os.path.basename(dataset.path) if dataset is not None else None,
+            'loading': loading is not None and loading.is_alive(),
+            'lastError': self.last_error,
+        }
+
+    def _swap(self, dataset: Dataset) -> Dataset:
+        with self._lock:
+            old, self._current = self._current, dataset
+        if old is not None:
+            old.dispose()
+            logging.info('dataset is swapped: %s', dataset.path)
+        return dataset
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output', default=DEFAULT_DATASET_PATH)
+    parser.add_argument('--check', action='store_true',
+                        help='データセットが古い場合にエラー終了します。')
+    parser.add_argument('--validate', action='store_true',
+                        help='レシピの分速などを確認し、警告を表示します。')
+    parser.add_argument('--workers', type=int,
+                        help='生産計画を計算するプロセス数。省略時はCPU数、0は並列にしません。')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    if args.check:
+        if is_stale(args.output):
+            print(f'{args.output} is stale (expected {seeddata_hash()}, '
+                  f'actual {read_dataset_version(args.output)})')
+            sys.exit(1)
+        print(f'{args.output} is up to date ({read_dataset_version(args.output)})')
+        return
+
+    build_dataset(args.output, args.validate, args.workers)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+import pathlib
+import sqlite3
+from typing import Any
+
+# 読み取り専用プロファイルで使うSQLiteの設定
+SQLITE_MMAP_SIZE = 256 * 1024 * 1024
+SQLITE_CACHE_KIB = 64 * 1024
+
+
+def readonly_engine_options(path: str) -> dict[str, Any]:
+    """ビルド後に書き換えないデータセットを読むための、エンジンの設定を作成します。
+
+    mode=ro&immutable=1 で開くことでロックや変更の確認を省略し、
+    ファイル全体をmmapで読み込みます。接続はプールされ、ワーカー内で使い回されます。
+    """
+    uri = pathlib.Path(path).resolve().as_uri() + '?mode=ro&immutable=1'
+
+    def connect() -> sqlite3.Connection:
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        conn.execute(f'PRAGMA mmap_size = {SQLITE_MMAP_SIZE}')
+        conn.execute(f'PRAGMA cache_size = -{SQLITE_CACHE_KIB}')
+        conn.execute('PRAGMA query_only = 1')
+        return conn
+
+    return {
+        'creator': connect,
+        # 書き込みがないため、返却時のROLLBACKは不要です。
+        'pool_reset_on_return': None,
+    }
+
+
+def engine_options(profile: str, path: str) -> dict[str, Any]:
+    """プロファイル名に応じたエンジンの設定を返します。
+
+      default : 通常の読み書き可能な接続
+      readonly: 読み取り専用・immutableの接続
+    """
+    match profile:
+        case 'default':
+            return {}
+        case 'readonly':
+            return readonly_engine_options(path)
+        case _:
+            raise ValueError(f'unknown db profile "{profile}"')
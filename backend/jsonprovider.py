@@ -0,0 +1,49 @@
+import logging
+from typing import Any
+from flask import Flask, Response
+from flask.json.provider import JSONProvider, _default
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class OrjsonProvider(JSONProvider):
+    """orjsonを使ってJSONの変換を行います。
+
+    出力はFlask標準のプロバイダと同じく、キーをソートした形式になります。
+    """
+
+    def _options(self) -> int:
+        option = orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS
+        if self._app.debug:
+            option |= orjson.OPT_INDENT_2
+        return option
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        return orjson.dumps(obj, default=_default, option=self._options()).decode('utf-8')
+
+    def loads(self, s: str | bytes, **kwargs: Any) -> Any:
+        return orjson.loads(s)
+
+    def response(self, *args: Any, **kwargs: Any) -> Response:
+        obj = self._prepare_response_obj(args, kwargs)
+        data = orjson.dumps(obj, default=_default,
+                            option=self._options() | orjson.OPT_APPEND_NEWLINE)
+        return self._app.response_class(data, mimetype='application/json')
+
+
+def init_json_provider(app: Flask, name: str = 'default') -> None:
+    """nameが'orjson'の場合は、JSONプロバイダをorjsonに置き換えます。
+
+    orjsonは日本語などを\\uでエスケープせずにUTF-8のまま出力するため、
+    Flask標準のプロバイダとは出力のバイト列が異なります。
+    orjsonがインストールされていない場合は、標準のプロバイダを使います。
+    """
+    if name != 'orjson':
+        return
+    if orjson is None:
+        logging.warning('orjson is not installed, using the default JSON provider')
+        return
+    app.json = OrjsonProvider(app)
@@ -1,10 +1,40 @@
 #!/usr/bin/python
+import hashlib
 import math
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
 import pulp
-from models import Item, Recipe
 
+from catalog import Catalog, RecipeNode, get_catalog
+from dataset import Dataset
 
-# 
+# プランナーの計算の統計 (秒数、変数の数、制約の数、ソルバーの結果)
+PlanStats = namedtuple('PlanStats', ['seconds', 'variables', 'constraints', 'status'])
+
+# 作成済みのモデルを保持する数
+MODEL_CACHE_SIZE = int(os.environ.get('SF_PLANNER_MODEL_CACHE', '32'))
+
+# solveで指定できる目的関数
+#   byproducts: 副産物の合計生産量 (プランナーのデフォルト)
+#   raw       : 材料(ingredients)の合計消費量
+#   power     : 施設と水の汲み上げの消費電力 (ダウンクロックは考えません)
+#   buildings : 施設数の合計 (端数を含みます)
+OBJECTIVES = ('byproducts', 'raw', 'power', 'buildings')
+
+# byproducts以外の目的関数に加える、副産物の合計生産量の重み
+#   最適な解が複数ある場合に、不要な副産物を作らないものを選びます。
+BYPRODUCTS_WEIGHT = 1e-3
+
+# 水の汲み上げの消費電力 (ウォーターポンプ1台で20MW、毎分120m3)
+WATER_POWER = 20 / 120.0
+
+# これより小さいレシピの施設数や流量は、ソルバーの誤差として扱います。
+FLOW_EPSILON = 1e-4
+
+
+#
 def get_value(var: pulp.LpVariable, ndigits: int | None = None) -> float:
     value = var.value()
     if value is None:
@@ -28,62 +58,102 @@ def calc_consum(power: float, count: float) -> float:
     return power * count_int + decimal_power
 
 
+def count_recipes(counts: list[tuple[RecipeNode, float]]) -> tuple[dict[str, int],
+                                                                    dict[str, float]]:
+    """レシピごとの施設数から、レスポンスのbuildingsとrecipesを作成します。
+
+    プランナーと計算済みの計画(precompute.scale_plan)で共通に使います。
+    recipesのキーはレシピのIDで、どちらも使わない(FLOW_EPSILON以下の)レシピは含めません。
+    """
+    buildings = {}
+    recipes = {}
+    for recipe, count in counts:
+        if count <= FLOW_EPSILON:
+            continue
+        # 割り切れる施設数が、浮動小数点の誤差で1台多くならないようにします。
+        buildings[recipe.building_id] = \
+            buildings.get(recipe.building_id, 0) + math.ceil(round(count, 6))
+        recipes[recipe.id] = round(count, 3)
+    return buildings, recipes
+
+
+def find_amount(amounts: tuple, item_id: str):
+    for amount in amounts:
+        if amount.item_id == item_id:
+            return amount
+    return None
+
+
 class ProductionPlanner:
-    def __init__(self, recipe_ids: list[str], products: list[tuple[str, float]],
-                 ingredients: list[str]):
-        recipes = Recipe.query.filter(Recipe.id.in_(recipe_ids)).all()
-        self.recipes_data = [(recipe, pulp.LpVariable(recipe.id, 0))
-                             for recipe in recipes]
-        self.products = products
-        self.ingredients = ingredients
-    
-    def has_product(self, item_id: str) -> bool:
-        for id, _ in self.products:
-            if item_id == id:
-                return True
-        return False
-
-    def total_products(self, id: str) -> pulp.LpAffineExpression:
-        values = []
-        for [recipe, p_recipe] in self.recipes_data:
-            prod = recipe.find_product(id)
-            if prod is not None:
-                values.append(p_recipe * prod.minute)
-        return pulp.lpSum(values)
+    """レシピの組み合わせごとに作成する、生産計画の線形計画モデルです。
+
+    モデルはレシピの組み合わせが同じリクエストで使い回し、solveでは生産物と材料の
+    制約の向きと右辺だけを書き換えて計算します。
+    計算中はモデルの変数に値が入るため、solveはロックを取って1つずつ行います。
+    """
+
+    def __init__(self, catalog: Catalog, recipe_ids: list[str]):
+        recipes = sorted((catalog.recipes[id] for id in set(recipe_ids)
+                          if id in catalog.recipes), key=lambda r: r.id)
+        self.recipes_data: list[tuple[RecipeNode, pulp.LpVariable]] = \
+            [(recipe, pulp.LpVariable(recipe.id, 0)) for recipe in recipes]
+        self.lock = threading.Lock()
+
+        # 素材ごとの正味の生産量と、その制約
+        #   制約の向きと右辺はsolveで設定します。最初はすべて 正味の生産量 >= 0 です。
+        self.prob = pulp.LpProblem('ProductionPlanning', pulp.LpMinimize)
+        self.net_productions: dict[str, pulp.LpAffineExpression] = {}
+        self.net_constraints: dict[str, pulp.LpConstraint] = {}
+        for item_id in catalog.items:
+            values = []
+            for recipe, p_recipe in self.recipes_data:
+                prod = find_amount(recipe.products, item_id)
+                if prod is not None:
+                    values.append(p_recipe * prod.minute)
+                ing = find_amount(recipe.ingredients, item_id)
+                if ing is not None:
+                    values.append(p_recipe * -ing.minute)
+            net_prod = pulp.lpSum(values)
+            self.net_productions[item_id] = net_prod
+            constraint = net_prod >= 0
+            self.prob += constraint, f'net_{item_id}'
+            self.net_constraints[item_id] = constraint
 
-    def total_ingredients(self, id: str) -> pulp.LpAffineExpression:
+        # 副産物(valueが0以上)の合計生産量が最小になるようにします。
+        #   up0には max(生産量, 0) の値が入ります。
+        #   生産対象の素材は生産量が固定されるため、目的関数に含めても結果は変わりません。
         values = []
-        for[recipe, p_recipe] in self.recipes_data:
-            ing = recipe.find_ingredient(id)
-            if ing is not None:
-                values.append(p_recipe * ing.minute)
-        return pulp.lpSum(values)
-
-    def _make_net_productions(self, prob: pulp.LpProblem) -> dict:
-        net_productions = {}
-        for item in Item.query.all():
-            total_prod = self.total_products(item.id)
-            total_ing = self.total_ingredients(item.id)
-            net_prod = total_prod - total_ing
-            net_productions[item.id] = net_prod
-
-            if item.id in self.ingredients:
-                prob += net_prod <= 0
-            else:
-                prob += net_prod >= 0
+        for item_id, net_prod in self.net_productions.items():
+            up0 = pulp.LpVariable(f'up0_{item_id}')
+            self.prob += up0 >= net_prod
+            self.prob += up0 >= 0
+            values.append(up0)
+        self.byproducts = pulp.lpSum(values)
+        self.prob += self.byproducts
 
-        for product_id, value in self.products:
-            net_prod = net_productions.get(product_id, None)
-            if net_prod is not None:
-                prob += net_prod == value
+        self.variable_count = len(self.prob.variables())
+        self.constraint_count = len(self.prob.constraints)
+        self.status = None
 
-        return net_productions
+    def _set_targets(self, products: list[tuple[str, float]], ingredients: list[str]):
+        """生産物と材料に合わせて、制約の向きと右辺を設定します。"""
+        targets = dict(products)
+        for item_id, constraint in self.net_constraints.items():
+            if item_id in targets:
+                constraint.sense = pulp.LpConstraintEQ
+                constraint.constant = -targets[item_id]
+            elif item_id in ingredients:
+                constraint.sense = pulp.LpConstraintLE
+                constraint.constant = 0
+            else:
+                constraint.sense = pulp.LpConstraintGE
+                constraint.constant = 0
 
-    def _get_powers(self) -> tuple[pulp.LpAffineExpression, pulp.LpAffineExpression]:
+    def _get_powers(self) -> tuple[float, float]:
         consums = []
         powers = []
         for [recipe, p_recipe] in self.recipes_data:
-            power = recipe.get_power()
+            power = recipe.power
             if power is None:
                 pass
             elif power >= 0:
@@ -92,40 +162,152 @@ class ProductionPlanner:
                 consums.append(calc_consum(-power, p_recipe.value()))
         return sum(consums), sum(powers)
 
-    def solve(self) -> tuple[dict[str, float], float, float]:
-        prob = pulp.LpProblem('ProductionPlanning', pulp.LpMinimize)
-        net_productions = self._make_net_productions(prob)
+    def _set_disabled(self, disabled: frozenset[str]):
+        """disabledのレシピは、上限を0にして使わないようにします。"""
+        for recipe, p_recipe in self.recipes_data:
+            p_recipe.upBound = 0 if recipe.id in disabled else None
 
-        # 生産対象ではない副産物(valueが0以上)の合計生産量が
-        # 最小になるようにします。
-        values = []
-        for item_id, value in net_productions.items():
-            if self.has_product(item_id):
-                continue
+    def _objective(self, objective: str, ingredients: list[str]) -> pulp.LpAffineExpression:
+        """OBJECTIVESの名前に対応する目的関数を作成します。"""
+        if objective == 'byproducts':
+            return self.byproducts
 
-            # up0には max(生産量, 0) の値が入ります。
-            up0 = pulp.LpVariable(f'up0_{item_id}')
-            prob += up0 >= value
-            prob += up0 >= 0
-            values.append(up0)
-        prob += pulp.lpSum(values)
+        if objective == 'raw':
+            values = [-self.net_productions[id] for id in set(ingredients)
+                      if id in self.net_productions]
+        elif objective == 'power':
+            values = [-recipe.power * p_recipe for recipe, p_recipe in self.recipes_data
+                      if recipe.power is not None and recipe.power < 0]
+            if 'Water' in ingredients and 'Water' in self.net_productions:
+                values.append(-WATER_POWER * self.net_productions['Water'])
+        elif objective == 'buildings':
+            values = [p_recipe for _, p_recipe in self.recipes_data]
+        else:
+            raise ValueError(f'unknown objective: {objective}')
+        return pulp.lpSum(values) + BYPRODUCTS_WEIGHT * self.byproducts
+
+    def solve(self, products: list[tuple[str, float]], ingredients: list[str],
+              disabled: frozenset[str] = frozenset(),
+              objective: str = 'byproducts') -> tuple[dict[str, float], float, float]:
+        self._set_targets(products, ingredients)
+        self._set_disabled(disabled)
+        self.prob.setObjective(self._objective(objective, ingredients))
 
         solver = pulp.PULP_CBC_CMD(gapRel=1e-7)
-        prob.solve(solver)
+        self.prob.solve(solver)
+        self.status = pulp.LpStatus[self.prob.status]
 
         consum, power = self._get_powers()
-        consum += calc_consum(20, -get_value(net_productions['Water']) / 120.0)
-        net_result = {k: get_value(v, 3) for k,v in net_productions.items()
+        consum += calc_consum(20, -get_value(self.net_productions['Water']) / 120.0)
+        net_result = {k: get_value(v, 3) for k,v in self.net_productions.items()
                       if math.fabs(get_value(v)) > 1e-4}
         return net_result, round(consum, 3), round(power, 3)
 
-    def get_building_counts(self) -> dict[int]:
-        result = {}
-        for [recipe, p_recipe] in self.recipes_data:
-            exist = result.get(recipe.building.id, 0)
-            result[recipe.building.id] = exist + math.ceil(get_value(p_recipe))
-        return result
+    def get_counts(self) -> tuple[dict[str, int], dict[str, float]]:
+        """計算結果の施設ごと・レシピごとの数です。(count_recipesを参照)"""
+        return count_recipes([(recipe, get_value(p_recipe))
+                              for recipe, p_recipe in self.recipes_data])
+
+    def get_building_counts(self) -> dict[str, int]:
+        return self.get_counts()[0]
+
+    def get_recipe_counts(self) -> dict[str, float]:
+        return self.get_counts()[1]
+
+    def get_flows(self) -> list[dict]:
+        """計算結果を、素材ごとの生産するレシピから消費するレシピへの流れに分解します。
+
+        素材ごとに生産側と消費側を順に突き合わせる(北西隅法)ため、流れの数は
+        素材ごとに 生産側の数 + 消費側の数 - 1 以下で、計算量はレシピの生産物と材料の
+        数の合計に比例します。
+        レシピはget_recipe_countsと同じくIDで、外部から供給する材料はfromが、
+        生産物や余った副産物はtoがNoneになります。
+        """
+        # 素材ごとの [レシピの名前, 分速] (Noneは外部)
+        supplies: dict[str, list[list]] = {}
+        demands: dict[str, list[list]] = {}
+        for recipe, p_recipe in self.recipes_data:
+            count = get_value(p_recipe)
+            if count <= FLOW_EPSILON:
+                continue
+            for prod in recipe.products:
+                supplies.setdefault(prod.item_id, []).append([recipe.id, count * prod.minute])
+            for ing in recipe.ingredients:
+                demands.setdefault(ing.item_id, []).append([recipe.id, count * ing.minute])
+
+        flows = []
+        for item_id in dict.fromkeys([*supplies, *demands]):
+            item_supplies = supplies.get(item_id, [])
+            item_demands = demands.get(item_id, [])
+            net = sum(rate for _, rate in item_supplies) - sum(rate for _, rate in item_demands)
+            if net < 0:
+                item_supplies.append([None, -net])
+            elif net > 0:
+                item_demands.append([None, net])
+
+            i = j = 0
+            while i < len(item_supplies) and j < len(item_demands):
+                supply = item_supplies[i]
+                demand = item_demands[j]
+                rate = min(supply[1], demand[1])
+                if rate > FLOW_EPSILON:
+                    flows.append({'item': item_id, 'from': supply[0], 'to': demand[0],
+                                  'rate': round(rate, 3)})
+                supply[1] -= rate
+                demand[1] -= rate
+                if supply[1] <= FLOW_EPSILON:
+                    i += 1
+                if demand[1] <= FLOW_EPSILON:
+                    j += 1
+        return flows
+
+
+_models: OrderedDict[tuple, ProductionPlanner] = OrderedDict()
+_models_lock = threading.Lock()
+
+
+def recipe_set_hash(recipe_ids: list[str]) -> str:
+    return hashlib.sha1('\n'.join(sorted(set(recipe_ids))).encode('utf-8')).hexdigest()
+
+
+def get_planner(dataset: Dataset, recipe_ids: list[str]) -> ProductionPlanner:
+    """レシピの組み合わせのモデルを返します。なければ作成し、LRUで保持します。"""
+    key = (dataset.version, recipe_set_hash(recipe_ids))
+    with _models_lock:
+        planner = _models.get(key)
+        if planner is not None:
+            _models.move_to_end(key)
+            return planner
+
+    planner = ProductionPlanner(get_catalog(dataset), recipe_ids)
+    with _models_lock:
+        planner = _models.setdefault(key, planner)
+        while len(_models) > MODEL_CACHE_SIZE:
+            _models.popitem(last=False)
+    return planner
+
+
+def solve_plan(dataset: Dataset, recipe_ids: list[str], products: list[tuple[str, float]],
+               ingredients: list[str], flows: bool = False) -> tuple[dict, PlanStats]:
+    """プランナーの計算を行い、APIのレスポンスの形式と計算の統計を返します。
 
-    def get_recipe_counts(self) -> dict[float]:
-        return {p_recipe.name: get_value(p_recipe, 3)
-                for _, p_recipe in self.recipes_data}
+    flowsがTrueの場合は、レシピ間の素材の流れ(get_flows)もレスポンスに含めます。
+    """
+    start = time.perf_counter()
+    planner = get_planner(dataset, recipe_ids)
+    with planner.lock:
+        net, consum, power = planner.solve(products, ingredients)
+        buildings, recipes = planner.get_counts()
+        result = {
+            'consume': consum,
+            'power': power,
+            'net': net,
+            'buildings': buildings,
+            'recipes': recipes,
+        }
+        if flows:
+            result['flows'] = planner.get_flows()
+        status = planner.status
+    stats = PlanStats(time.perf_counter() - start, planner.variable_count,
+                      planner.constraint_count, status)
+    return result, stats
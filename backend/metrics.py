@@ -0,0 +1,159 @@
+"""Prometheusのテキスト形式で出力する、軽量なメトリクスです。
+
+値の更新はロックを取って数値を足すだけなので、本番環境でも有効にしたまま使えます。
+値はプロセスごとに集計されます。
+"""
+import threading
+from typing import Callable, Iterable
+
+# 応答時間などのヒストグラムのバケット(秒)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 30)
+# リクエストごとのDBクエリ数などのバケット
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def format_labels(names: Iterable[str], values: Iterable) -> str:
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def samples(self) -> Iterable[tuple[str, tuple, float]]:
+        return ()
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        for name, labels, value in self.samples():
+            lines.append(f'{name}{labels} {format_value(value)}')
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = ()):
+        super().__init__(name, help, labels)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, *label_values, amount: float = 1) -> None:
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def get(self, *label_values) -> float:
+        return self._values.get(label_values, 0)
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for label_values, value in values:
+            yield self.name, format_labels(self.labels, label_values), value
+
+
+class Gauge(Metric):
+    """出力時にfunctionを呼び出して値を取得するゲージです。
+
+    functionはラベルの値のタプルから値への辞書を返します。
+    """
+    kind = 'gauge'
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = (),
+                 function: Callable[[], dict[tuple, float]] | None = None):
+        super().__init__(name, help, labels)
+        self.function = function
+
+    def samples(self):
+        values = self.function() if self.function is not None else {}
+        for label_values, value in sorted(values.items()):
+            yield self.name, format_labels(self.labels, label_values), value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = (),
+                 buckets: Iterable[float] = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets) + (float('inf'),)
+        # ラベルの値ごとの [バケットごとの件数..., 合計値, 件数]
+        self._values: dict[tuple, list] = {}
+
+    def observe(self, value: float, *label_values) -> None:
+        with self._lock:
+            data = self._values.get(label_values)
+            if data is None:
+                data = self._values[label_values] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    data[i] += 1
+                    break
+            data[-2] += value
+            data[-1] += 1
+
+    def samples(self):
+        with self._lock:
+            values = sorted((k, list(v)) for k, v in self._values.items())
+        names = self.labels + ('le',)
+        for label_values, data in values:
+            total = 0
+            for i, bound in enumerate(self.buckets):
+                total += data[i]
+                yield (f'{self.name}_bucket',
+                       format_labels(names, label_values + (format_value(bound),)), total)
+            labels = format_labels(self.labels, label_values)
+            yield f'{self.name}_sum', labels, data[-2]
+            yield f'{self.name}_count', labels, data[-1]
+
+
+REGISTRY: list[Metric] = []
+
+
+def render() -> str:
+    return '\n'.join(metric.render() for metric in REGISTRY) + '\n'
+
+
+REQUEST_SECONDS = Histogram(
+    'sf_request_duration_seconds', 'Request latency by route.',
+    ['route', 'method', 'status'])
+REQUEST_DB_QUERIES = Histogram(
+    'sf_request_db_queries', 'DB queries executed per request by route.',
+    ['route'], buckets=COUNT_BUCKETS)
+
+PLANNER_SOLVE_SECONDS = Histogram(
+    'sf_planner_solve_seconds', 'Planner model build and CBC solve time.')
+PLANNER_VARIABLES = Histogram(
+    'sf_planner_variables', 'Number of LP variables per planner model.',
+    buckets=COUNT_BUCKETS)
+PLANNER_CONSTRAINTS = Histogram(
+    'sf_planner_constraints', 'Number of LP constraints per planner model.',
+    buckets=COUNT_BUCKETS)
+PLANNER_STATUS = Counter(
+    'sf_planner_solves_total', 'Planner solves by solver status.', ['status'])
+
+
+def observe_plan(stats) -> None:
+    """プランナーの計算結果(linerprog.PlanStats)を記録します。"""
+    PLANNER_SOLVE_SECONDS.observe(stats.seconds)
+    PLANNER_VARIABLES.observe(stats.variables)
+    PLANNER_CONSTRAINTS.observe(stats.constraints)
+    PLANNER_STATUS.inc(stats.status)
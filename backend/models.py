@@ -1,8 +1,28 @@
 import datetime
+import operator
+from typing import Callable
+from flask import g, has_app_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_sqlalchemy.model import Model
+from flask_sqlalchemy.session import Session
+from sqlalchemy import Interval
 
-db = SQLAlchemy()
+
+class DatasetSession(Session):
+    """リクエスト開始時に固定したデータセット(g.dataset)のDBを使うセッションです。
+
+    データセットが入れ替わっても、処理中のリクエストは開始時のデータセットを使い続けます。
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and has_app_context():
+            dataset = g.get('dataset')
+            if dataset is not None:
+                return dataset.engine
+        return super().get_bind(mapper, clause, bind, **kwargs)
+
+
+db = SQLAlchemy(session_options={'class_': DatasetSession})
 
 
 def to_camel_case(text):
@@ -13,20 +33,47 @@ def to_camel_case(text):
     return s[0] + ''.join(i.capitalize() for i in s[1:])
 
 
-def model_to_dict(model: type[Model]):
-    def convert(value: any) -> any:
-        match type(value):
-            case datetime.timedelta:
-                return value.total_seconds()
-        return value
+def make_serializer(model_class: type[Model]) -> Callable[[Model], dict]:
+    """モデルクラスごとに、辞書へ変換する関数を作成します。
+
+    camelCaseのキー名や日時型の変換対象はクラス作成時に一度だけ計算します。
+    """
+    columns = model_class.__table__.columns
+    names = tuple(column.name for column in columns)
+    keys = tuple(to_camel_case(name) for name in names)
+    getter = operator.attrgetter(*names)
+    interval_keys = tuple(to_camel_case(column.name) for column in columns
+                          if isinstance(column.type, Interval))
+    has_link = hasattr(model_class, 'wiki_link')
+
+    def serialize(model: Model) -> dict:
+        values = getter(model)
+        result = dict(zip(keys, values if len(keys) > 1 else (values,)))
+
+        for key in interval_keys:
+            value = result[key]
+            if isinstance(value, datetime.timedelta):
+                result[key] = value.total_seconds()
+
+        if has_link:
+            link = getattr(model, 'wiki_link', None)
+            if link:
+                result['wikiLink'] = link
+        return result
 
-    result = {to_camel_case(column.name): convert(getattr(model, column.name))
-              for column in model.__table__.columns}
-    
-    link = getattr(model, 'wiki_link', None)
-    if link:
-        result['wikiLink'] = link
-    return result
+    return serialize
+
+
+_serializers: dict[type[Model], Callable[[Model], dict]] = {}
+
+
+def model_to_dict(model: Model) -> dict:
+    model_class = type(model)
+    serializer = _serializers.get(model_class)
+    if serializer is None:
+        serializer = make_serializer(model_class)
+        _serializers[model_class] = serializer
+    return serializer(model)
 
 
 class Item(db.Model):
@@ -304,3 +351,19 @@ class Condition(db.Model):
 
     def __str__(self):
         return self.name
+
+
+class DatasetInfo(db.Model):
+    """ビルド済みデータセットのバージョンなどを保持します。"""
+    __tablename__ = 'dataset_info'
+    key = db.Column(db.String(64), primary_key=True)
+    value = db.Column(db.String(256), nullable=False)
+
+
+class PrecomputedPlan(db.Model):
+    """データセットの作成時に計算した、素材を毎分1個生産する最適な計画です。(precompute.py)"""
+    __tablename__ = 'precomputed_plan'
+    item_id = db.Column(db.String(128), db.ForeignKey('item.id'), primary_key=True)
+    objective = db.Column(db.String(32), primary_key=True)  # 'raw', 'power', 'buildings'
+    recipes = db.Column(db.Text, nullable=False)  # {レシピのID: 施設数} のJSON
+    net = db.Column(db.Text, nullable=False)  # {素材のID: 正味の分速} のJSON
@@ -0,0 +1,199 @@
+"""プランナーの計算結果を、プロセスをまたいで保持するSQLiteのストアです。
+
+Lambdaのコンテナが入れ替わるとメモリ上のキャッシュは失われるため、
+計算結果をファイルに保存し、同じ入力のリクエストでは計算を省略します。
+キーはプランナーの入力を正規化したもの(app.planner_key)で、データセットの
+バージョンを含みます。合計サイズが上限を超えると、使われていない順に削除します。
+
+読み込み(get)では書き込みを行いません。最後に使った時刻はプロセスのメモリに貯めておき、
+TOUCH_BATCH件かTOUCH_INTERVAL秒ごとにまとめて書き込みます。
+合計サイズはトリガーでplan_totalテーブルに集計し、追加のたびに全体を数え直すことはしません。
+
+ジャーナルモードは、EFSなどのネットワークファイルシステムでも使えるDELETE(ロールバック
+ジャーナル)がデフォルトです。WALは共有メモリを使うため、1台のホストのローカルディスクで
+使う場合にだけ指定してください。
+
+ストアはキャッシュとして使うため、ロックの待ち時間切れなどのエラーはログに記録するだけで、
+getは見つからなかったもの、putは何もしなかったものとして扱います。
+
+ローカル環境では任意のファイルを指定して、そのまま試すことができます。
+"""
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Hashable, Iterator
+
+import metrics
+
+REQUESTS = metrics.Counter('sf_plan_store_requests_total',
+                           'Plan store lookups and failed reads/writes by result.', ['result'])
+EVICTIONS = metrics.Counter('sf_plan_store_evictions_total',
+                            'Plans evicted from the plan store.')
+
+# 削除するときは、上限のこの割合まで減らします。
+EVICT_RATIO = 0.9
+
+# 最後に使った時刻は、この件数かこの秒数ごとにまとめて書き込みます。
+TOUCH_BATCH = 64
+TOUCH_INTERVAL = 30.0
+
+JOURNAL_MODES = ('delete', 'wal')
+
+SCHEMA = '''
+BEGIN IMMEDIATE;
+CREATE TABLE IF NOT EXISTS plan (
+    key TEXT PRIMARY KEY,
+    version TEXT NOT NULL,
+    value BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS plan_last_used ON plan (last_used);
+CREATE TABLE IF NOT EXISTS plan_total (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    bytes INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO plan_total (id, bytes) SELECT 0, COALESCE(SUM(size), 0) FROM plan;
+CREATE TRIGGER IF NOT EXISTS plan_total_insert AFTER INSERT ON plan BEGIN
+    UPDATE plan_total SET bytes = bytes + NEW.size WHERE id = 0;
+END;
+CREATE TRIGGER IF NOT EXISTS plan_total_update AFTER UPDATE OF size ON plan BEGIN
+    UPDATE plan_total SET bytes = bytes + NEW.size - OLD.size WHERE id = 0;
+END;
+CREATE TRIGGER IF NOT EXISTS plan_total_delete AFTER DELETE ON plan BEGIN
+    UPDATE plan_total SET bytes = bytes - OLD.size WHERE id = 0;
+END;
+COMMIT;
+'''
+
+
+def store_key(key: Hashable) -> str:
+    """正規化した入力(タプル)を、テーブルのキーに使うハッシュ値にします。"""
+    text = json.dumps(key, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class PlanStore:
+    def __init__(self, path: str, max_bytes: int, journal_mode: str = 'delete'):
+        if journal_mode not in JOURNAL_MODES:
+            raise ValueError(f'unknown journal mode: {journal_mode}')
+        self.path = path
+        self.max_bytes = max_bytes
+        self.journal_mode = journal_mode
+        self._local = threading.local()
+        self._evict_lock = threading.Lock()
+        # まだ書き込んでいない、最後に使った時刻 (キー -> 時刻)
+        self._touched: dict[str, float] = {}
+        self._touch_lock = threading.Lock()
+        self._last_flush = time.monotonic()
+        self._connect().executescript(SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        """スレッドごとの接続を返します。"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute(f'PRAGMA journal_mode={self.journal_mode}')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        """複数の書き込みを、1つのトランザクションで行います。"""
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def get(self, key: Hashable) -> bytes | None:
+        """保存した計算結果を返します。ないか、読み込めなかった場合はNoneを返します。"""
+        id = store_key(key)
+        try:
+            row = self._connect().execute('SELECT value FROM plan WHERE key = ?',
+                                          (id,)).fetchone()
+        except sqlite3.Error:
+            logging.warning('failed to read the plan store', exc_info=True)
+            REQUESTS.inc('error')
+            return None
+        if row is None:
+            REQUESTS.inc('miss')
+            return None
+
+        REQUESTS.inc('hit')
+        try:
+            self.touch(id)
+        except sqlite3.Error:
+            logging.warning('failed to update the plan store', exc_info=True)
+        return row[0]
+
+    def touch(self, id: str) -> None:
+        """最後に使った時刻を記録します。書き込みはflush_touchesでまとめて行います。"""
+        with self._touch_lock:
+            self._touched[id] = time.time()
+            due = (len(self._touched) >= TOUCH_BATCH
+                   or time.monotonic() - self._last_flush >= TOUCH_INTERVAL)
+        if due:
+            self.flush_touches()
+
+    def flush_touches(self) -> None:
+        with self._touch_lock:
+            touched, self._touched = self._touched, {}
+            self._last_flush = time.monotonic()
+        if not touched:
+            return
+
+        with self._transaction() as conn:
+            conn.executemany('UPDATE plan SET last_used = ? WHERE key = ?',
+                             [(used, id) for id, used in touched.items()])
+
+    def put(self, key: Hashable, version: str, value: bytes) -> None:
+        """計算結果を保存します。書き込めなかった場合は保存しません。"""
+        try:
+            self._put(key, version, value)
+        except sqlite3.Error:
+            logging.warning('failed to write the plan store', exc_info=True)
+            REQUESTS.inc('error')
+
+    def _put(self, key: Hashable, version: str, value: bytes) -> None:
+        conn = self._connect()
+        conn.execute('INSERT INTO plan (key, version, value, size, last_used) '
+                     'VALUES (?, ?, ?, ?, ?) '
+                     'ON CONFLICT (key) DO UPDATE SET version = excluded.version, '
+                     'value = excluded.value, size = excluded.size, '
+                     'last_used = excluded.last_used',
+                     (store_key(key), version, value, len(value), time.time()))
+        if self.total_bytes() > self.max_bytes:
+            self.evict()
+
+    def total_bytes(self) -> int:
+        """合計サイズです。トリガーで集計した値を読むため、全体は数え直しません。"""
+        return self._connect().execute('SELECT bytes FROM plan_total WHERE id = 0').fetchone()[0]
+
+    def evict(self) -> int:
+        """合計サイズが上限を超えていれば、古いものから削除します。削除した件数を返します。"""
+        # 使った順に削除するため、貯めておいた時刻を先に書き込みます。
+        self.flush_touches()
+        with self._evict_lock, self._transaction() as conn:
+            total = self.total_bytes()
+            if total <= self.max_bytes:
+                return 0
+
+            target = total - int(self.max_bytes * EVICT_RATIO)
+            keys = []
+            for key, size in conn.execute('SELECT key, size FROM plan ORDER BY last_used'):
+                if target <= 0:
+                    break
+                keys.append((key,))
+                target -= size
+            conn.executemany('DELETE FROM plan WHERE key = ?', keys)
+        EVICTIONS.inc(amount=len(keys))
+        return len(keys)
@@ -0,0 +1,37 @@
+"""プランナーの計算を別プロセスで行うワーカーです。(asgi.pyから使います)
+
+ワーカーはspawnで起動し、アプリをlazyモードで読み込みます。
+データセットは呼び出し元と同じファイルを使い、入れ替えられた場合はそれに従います。
+"""
+import os
+
+
+def init_worker() -> None:
+    # DBの準備は親プロセスで済んでいるため、ワーカーでは行いません。
+    os.environ['SF_STARTUP_MODE'] = 'lazy'
+
+    # pulpなどの読み込みを最初のリクエストの前に済ませておきます。
+    import app  # noqa: F401
+    import linerprog  # noqa: F401
+
+
+def solve(dataset_path: str, recipe_ids: list[str], products: list[tuple[str, float]],
+          ingredients: list[str], flows: bool = False) -> tuple[dict, tuple]:
+    """linerprog.solve_planと同じく、レスポンスと計算の統計(PlanStats)を返します。"""
+    from app import datasets
+    from linerprog import solve_plan
+
+    if datasets.current.path != dataset_path:
+        datasets.open(dataset_path)
+    return solve_plan(datasets.current, recipe_ids, products, ingredients, flows)
+
+
+def evaluate(dataset_path: str, recipe_ids: list[str], products: list[tuple[str, float]],
+             ingredients: list[str], evaluations: list) -> list:
+    """alternates.evaluateを、このプロセスのデータセットで行います。"""
+    from app import datasets
+    from alternates import evaluate
+
+    if datasets.current.path != dataset_path:
+        datasets.open(dataset_path)
+    return evaluate(datasets.current, recipe_ids, products, ingredients, evaluations)
@@ -0,0 +1,192 @@
+"""データセットの作成時に、素材ごとの最適な生産計画を計算しておきます。
+
+「素材Xを毎分N個、最適なレシピで作る」計画は、生産量を変えても使うレシピの
+組み合わせと比率は変わりません。そこで生産できる素材ごと・目的関数(PLAN_OBJECTIVES)
+ごとに毎分1個の計画を計算してデータセット(precomputed_plan)に保存しておき、
+サーバーは生産量を掛けるだけで返します。
+
+計算は素材ごとに分割して、プロセスプールで並列に行います。
+"""
+import json
+import logging
+import math
+import multiprocessing
+import os
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from sqlalchemy import Engine, select
+
+from catalog import Catalog, get_catalog
+from dataset import Dataset
+from linerprog import calc_consum, count_recipes, get_planner, get_value
+from models import PrecomputedPlan
+
+# 計算しておく目的関数 (linerprog.OBJECTIVES)
+PLAN_OBJECTIVES = ('raw', 'power', 'buildings')
+
+# 手作業で作るレシピの施設です。計画には使いません。
+MANUAL_BUILDINGS = ('Build_Gun', 'Craft_Bench', 'Equipment_Workshop')
+
+# 保存する値の桁数 (生産量を掛けて使うため、レスポンスより細かくします)
+NDIGITS = 9
+# これより小さい値は、ソルバーの誤差として保存しません。
+EPSILON = 1e-6
+
+# 毎分1個の計画 (recipes: {レシピのID: 施設数}、net: {素材のID: 正味の分速})
+UnitPlan = namedtuple('UnitPlan', ['recipes', 'net'])
+
+# ワーカープロセスで開いたデータセット
+_datasets: dict[str, Dataset] = {}
+
+
+def plan_recipes(catalog: Catalog) -> list[str]:
+    """計画に使うレシピです。手作業以外のレシピを、代替レシピも含めてすべて使います。"""
+    return [recipe.id for recipe in catalog.recipes.values()
+            if recipe.building_id not in MANUAL_BUILDINGS]
+
+
+def plan_items(catalog: Catalog) -> list[str]:
+    """計画を計算する素材です。計画に使うレシピの主生産物のうち、基本資源以外のものです。"""
+    products = {catalog.recipes[id].products[0].item_id
+                for id in plan_recipes(catalog) if catalog.recipes[id].products}
+    return [id for id in catalog.items
+            if id in products and not catalog.is_raw_category(id)]
+
+
+def raw_items(catalog: Catalog) -> list[str]:
+    return [id for id in catalog.items if catalog.is_raw_category(id)]
+
+
+def solve_items(dataset: Dataset, item_ids: list[str]) -> list[dict]:
+    """素材ごと・目的関数ごとに毎分1個の計画を計算し、precomputed_planの行を返します。
+
+    基本資源から作れない素材など、最適解がないものは含めません。
+    """
+    catalog = get_catalog(dataset)
+    ingredients = raw_items(catalog)
+    planner = get_planner(dataset, plan_recipes(catalog))
+
+    rows = []
+    with planner.lock:
+        for item_id in item_ids:
+            for objective in PLAN_OBJECTIVES:
+                planner.solve([(item_id, 1)], ingredients, objective=objective)
+                if planner.status != 'Optimal':
+                    logging.debug('no plan for %s (%s): %s', item_id, objective, planner.status)
+                    continue
+
+                recipes = {recipe.id: get_value(p_recipe, NDIGITS)
+                           for recipe, p_recipe in planner.recipes_data
+                           if get_value(p_recipe) > EPSILON}
+                net = {id: get_value(net_prod, NDIGITS)
+                       for id, net_prod in planner.net_productions.items()
+                       if math.fabs(get_value(net_prod)) > EPSILON}
+                rows.append({'item_id': item_id, 'objective': objective,
+                             'recipes': json.dumps(recipes), 'net': json.dumps(net)})
+    return rows
+
+
+def _solve_chunk(path: str, item_ids: list[str]) -> list[dict]:
+    """ワーカープロセスで、データセットのファイルを開いてsolve_itemsを行います。"""
+    dataset = _datasets.get(path)
+    if dataset is None:
+        dataset = _datasets[path] = Dataset(path)
+    return solve_items(dataset, item_ids)
+
+
+def precompute_plans(path: str, workers: int | None = None) -> list[dict]:
+    """データセットのすべての素材の計画を計算し、precomputed_planの行を返します。
+
+    workersはプロセス数で、省略時はCPU数です。0の場合はこのプロセスで計算します。
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    dataset = Dataset(path)
+    try:
+        item_ids = plan_items(get_catalog(dataset))
+        if workers > 0:
+            chunks = [item_ids[i::workers] for i in range(min(workers, len(item_ids)))]
+            context = multiprocessing.get_context('spawn')
+            try:
+                with ProcessPoolExecutor(len(chunks), mp_context=context) as executor:
+                    results = executor.map(_solve_chunk, [path] * len(chunks), chunks)
+                    rows = [row for chunk_rows in results for row in chunk_rows]
+            except OSError:
+                # Lambdaなど、プロセスプールが使えない環境では順に計算します。
+                logging.warning('process pool is not available, precomputing serially')
+                rows = solve_items(dataset, item_ids)
+        else:
+            rows = solve_items(dataset, item_ids)
+    finally:
+        dataset.dispose()
+
+    # 作成するたびに同じ内容になるように、並びを揃えておきます。
+    order = {id: i for i, id in enumerate(item_ids)}
+    rows.sort(key=lambda row: (order[row['item_id']],
+                               PLAN_OBJECTIVES.index(row['objective'])))
+    return rows
+
+
+def load_plans(engine: Engine) -> dict[tuple[str, str], UnitPlan]:
+    """データセットの計算済みの計画を、(素材のID, 目的関数) ごとに読み込みます。"""
+    with engine.connect() as conn:
+        return {(item_id, objective): UnitPlan(json.loads(recipes), json.loads(net))
+                for item_id, objective, recipes, net in conn.execute(
+                    select(PrecomputedPlan.item_id, PrecomputedPlan.objective,
+                           PrecomputedPlan.recipes, PrecomputedPlan.net))}
+
+
+def scale_plan(catalog: Catalog, plan: UnitPlan, rate: float) -> dict:
+    """毎分1個の計画を毎分rate個にして、プランナーのレスポンスと同じ形式で返します。"""
+    counts = {id: count * rate for id, count in plan.recipes.items()}
+    net = {id: value * rate for id, value in plan.net.items()}
+
+    consums = []
+    powers = []
+    for id, count in counts.items():
+        recipe = catalog.recipes[id]
+        if recipe.power is None:
+            pass
+        elif recipe.power >= 0:
+            powers.append(recipe.power * count)
+        else:
+            consums.append(calc_consum(-recipe.power, count))
+    consum = sum(consums) + calc_consum(20, -net.get('Water', 0) / 120.0)
+    buildings, recipes = count_recipes([(catalog.recipes[id], count)
+                                        for id, count in counts.items()])
+
+    return {
+        'consume': round(consum, 3),
+        'power': round(sum(powers), 3),
+        'net': {id: round(value, 3) for id, value in net.items() if math.fabs(value) > 1e-4},
+        'buildings': buildings,
+        'recipes': recipes,
+    }
+
+
+def solve_item_plans(dataset: Dataset, item_id: str) -> dict[tuple[str, str], UnitPlan]:
+    """1つの素材の計画を、目的関数ごとにこのプロセスで計算します。"""
+    return {(row['item_id'], row['objective']): UnitPlan(json.loads(row['recipes']),
+                                                         json.loads(row['net']))
+            for row in solve_items(dataset, [item_id])}
+
+
+def get_precomputed_plan(dataset: Dataset, item_id: str, objective: str,
+                         rate: float) -> dict | None:
+    """計算済みの計画を毎分rate個にして返します。計画がなければNoneを返します。
+
+    import時の再作成など、計画を計算せずに作成したデータセットでは、
+    最初の要求時に素材ごとに計算して保持します。
+    """
+    plans = dataset.cached('precomputed_plans', lambda: load_plans(dataset.engine))
+    if not plans:
+        catalog = get_catalog(dataset)
+        if item_id not in dataset.cached('plan_items', lambda: frozenset(plan_items(catalog))):
+            return None
+        plans = dataset.cached(('item_plans', item_id),
+                               lambda: solve_item_plans(dataset, item_id))
+    plan = plans.get((item_id, objective))
+    if plan is None:
+        return None
+    return scale_plan(get_catalog(dataset), plan, rate)
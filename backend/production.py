@@ -0,0 +1,124 @@
+"""素材の生産に必要な上流の素材を、レシピの選択に従ってたどります。"""
+from collections import namedtuple
+from typing import Iterable
+
+from catalog import Catalog, get_catalog
+from dataset import Dataset
+
+# multiplierは、親の素材を1分あたり1個作るのに必要な、この素材の1分あたりの個数です。
+TreeEdge = namedtuple('TreeEdge', ['item_id', 'multiplier'])
+# buildings/powerは、この素材を1分あたり1個作るのに必要な施設数と電力(消費は負)です。
+TreeNode = namedtuple('TreeNode', ['item_id', 'recipe_id', 'buildings', 'power',
+                                   'edges', 'byproducts'])
+
+
+def recipe_profile(catalog: Catalog, recipe_ids: Iterable[str]) -> frozenset[str]:
+    """レシピの選択を、キャッシュのキーに使える形にします。"""
+    return frozenset(id for id in recipe_ids if id in catalog.recipes)
+
+
+class ProductionTree:
+    """あるレシピの選択での、素材ごとの上流のノードです。
+
+    ノードは必要になったときに作成してメモ化されるため、同じレシピの選択であれば
+    別の素材のリクエストでも共通する部分木を使い回します。
+    """
+
+    def __init__(self, catalog: Catalog, profile: frozenset[str]):
+        self.choice = catalog.choose_recipes(profile)
+        self.nodes: dict[str, TreeNode] = {}
+
+    def node(self, item_id: str) -> TreeNode:
+        node = self.nodes.get(item_id)
+        if node is None:
+            node = self._make_node(item_id)
+            self.nodes[item_id] = node
+        return node
+
+    def _make_node(self, item_id: str) -> TreeNode:
+        recipe = self.choice.get(item_id)
+        prod = None
+        if recipe is not None:
+            prod = next((p for p in recipe.products if p.item_id == item_id), None)
+
+        # レシピがない素材は基本資源として扱います。
+        if prod is None or not prod.minute:
+            return TreeNode(item_id, None, 0, 0, (), ())
+
+        edges = tuple(TreeEdge(ing.item_id, ing.minute / prod.minute)
+                      for ing in recipe.ingredients)
+        byproducts = tuple(TreeEdge(p.item_id, p.minute / prod.minute)
+                           for p in recipe.products if p.item_id != item_id)
+        buildings = 1 / prod.minute
+        return TreeNode(item_id, recipe.id, buildings, (recipe.power or 0) * buildings,
+                        edges, byproducts)
+
+    def upstream(self, item_id: str) -> tuple[list[str], set[tuple[str, str]]]:
+        """item_idから辿れる素材をトポロジカル順(item_idが先頭)で返します。
+
+        循環するレシピの辺は (親, 子) の組で別に返します。
+        """
+        order = []
+        cycles = set()
+        state = {}
+
+        def visit(id: str):
+            state[id] = 'visiting'
+            for edge in self.node(id).edges:
+                child_state = state.get(edge.item_id)
+                if child_state == 'visiting':
+                    cycles.add((id, edge.item_id))
+                elif child_state is None:
+                    visit(edge.item_id)
+            state[id] = 'done'
+            order.append(id)
+
+        visit(item_id)
+        order.reverse()
+        return order, cycles
+
+    def to_dict(self, item_id: str, rate: float) -> dict:
+        """item_idを1分あたりrate個作るときの、上流の素材と辺を返します。
+
+        循環する辺は需要を伝播させず、cycleとして示します。
+        """
+        order, cycles = self.upstream(item_id)
+        rates = dict.fromkeys(order, 0.0)
+        rates[item_id] = rate
+
+        nodes = []
+        edges = []
+        for id in order:
+            node = self.node(id)
+            node_rate = rates[id]
+            for edge in node.edges:
+                cycle = (id, edge.item_id) in cycles
+                if not cycle:
+                    rates[edge.item_id] += node_rate * edge.multiplier
+                edges.append({
+                    'from': edge.item_id,
+                    'to': id,
+                    'multiplier': edge.multiplier,
+                    'rate': node_rate * edge.multiplier,
+                    'cycle': cycle,
+                })
+
+            nodes.append({
+                'item': id,
+                'recipe': node.recipe_id,
+                'raw': node.recipe_id is None,
+                'rate': node_rate,
+                'buildings': node.buildings * node_rate,
+                'power': node.power * node_rate,
+                'byproducts': {bp.item_id: bp.multiplier * node_rate
+                               for bp in node.byproducts},
+            })
+
+        return {'item': item_id, 'rate': rate, 'nodes': nodes, 'edges': edges}
+
+
+def get_production_tree(dataset: Dataset, recipe_ids: Iterable[str] = ()) -> ProductionTree:
+    catalog = get_catalog(dataset)
+    profile = recipe_profile(catalog, recipe_ids)
+    return dataset.cached_profile(('production_tree', profile),
+                                  lambda: ProductionTree(catalog, profile))
@@ -0,0 +1,105 @@
+"""素材・建築物・レシピの名前をn-gramの転置インデックスで検索します。
+
+日本語の名前は部分一致で検索する必要があるため、正規化した名前と英語のIDを
+1文字と2文字のn-gramに分割してインデックスを作成します。
+"""
+import unicodedata
+from collections import namedtuple
+
+from catalog import Catalog, get_catalog
+from dataset import Dataset
+
+NGRAM_SIZE = 2
+
+# 検索結果の並び順 (種類)
+KIND_ORDER = {'item': 0, 'building': 1, 'recipe': 2}
+
+SearchEntry = namedtuple('SearchEntry', ['kind', 'id', 'name', 'index', 'texts'])
+
+
+def normalize_text(text: str) -> str:
+    """全角/半角や大文字/小文字、IDの'_'などの違いをなくします。"""
+    text = unicodedata.normalize('NFKC', text).lower()
+    return ' '.join(text.replace('_', ' ').split())
+
+
+def ngrams(text: str, size: int) -> set[str]:
+    return {text[i:i + size] for i in range(len(text) - size + 1)}
+
+
+class SearchIndex:
+    def __init__(self, entries: list[SearchEntry]):
+        self.entries = entries
+
+        postings = {}
+        for doc_id, entry in enumerate(entries):
+            grams = set()
+            for text in entry.texts:
+                for size in range(1, NGRAM_SIZE + 1):
+                    grams |= ngrams(text, size)
+            for gram in grams:
+                postings.setdefault(gram, []).append(doc_id)
+        self.postings: dict[str, frozenset[int]] = \
+            {gram: frozenset(ids) for gram, ids in postings.items()}
+
+    def candidates(self, query: str) -> frozenset[int]:
+        """queryのn-gramをすべて含むエントリを返します。"""
+        size = min(len(query), NGRAM_SIZE)
+        grams = ngrams(query, size)
+
+        # 件数の少ないものから積集合を取り、空になった時点で打ち切ります。
+        lists = sorted((self.postings.get(gram, frozenset()) for gram in grams), key=len)
+        result = lists[0]
+        for ids in lists[1:]:
+            if not result:
+                break
+            result = result & ids
+        return result
+
+    def search(self, query: str, limit: int = 20) -> list[SearchEntry]:
+        """名前かIDにqueryを含むエントリを、一致の度合いの順に返します。
+
+        完全一致、前方一致、部分一致の順で、同じ場合は短い名前を優先します。
+        """
+        query = normalize_text(query)
+        if not query:
+            return []
+
+        scored = []
+        for doc_id in self.candidates(query):
+            entry = self.entries[doc_id]
+            best = None
+            for text in entry.texts:
+                pos = text.find(query)
+                if pos < 0:
+                    continue
+                rank = 0 if text == query else 1 if pos == 0 else 2
+                key = (rank, len(text), pos)
+                if best is None or key < best:
+                    best = key
+            if best is not None:
+                scored.append((best, KIND_ORDER[entry.kind], entry.index, entry))
+
+        scored.sort(key=lambda s: s[:3])
+        return [s[3] for s in scored[:limit]]
+
+
+def build_search_index(catalog: Catalog) -> SearchIndex:
+    entries = []
+
+    def add(kind: str, node: any):
+        texts = (normalize_text(node.name), normalize_text(node.id))
+        entries.append(SearchEntry(kind, node.id, node.name, node.index, texts))
+
+    for item in catalog.items.values():
+        add('item', item)
+    for building in catalog.buildings.values():
+        add('building', building)
+    for recipe in catalog.recipes.values():
+        add('recipe', recipe)
+    return SearchIndex(entries)
+
+
+def get_search_index(dataset: Dataset) -> SearchIndex:
+    return dataset.cached('search_index',
+                          lambda: build_search_index(get_catalog(dataset)))
@@ -1,12 +1,21 @@
 import datetime
+import logging
 import os
 import sys
 import yaml
 from typing import Iterator
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import Connection
 from models import Building, Item, Recipe, RecipeItem, \
                    Condition, ConditionItem
 
+# libyamlがあればCのローダーを使います。
+YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# 外部キーの参照先から順に挿入します。
+SEED_MODELS = (Item, Building, Condition, Recipe, RecipeItem, ConditionItem)
+
+SeedRow = tuple[type, dict]
+
 
 def to_id(word: str) -> str:
     return word.strip().replace(' ', '_')
@@ -24,28 +33,44 @@ def to_float(value: str) -> float | None:
     return float(value)
 
 
-def make_seeddata(db: SQLAlchemy) -> Iterator[any]:
-    for item in load_items():
-        yield item
+def make_seedrows(validate: bool = False) -> Iterator[SeedRow]:
+    """シードデータを (モデルクラス, 列の値) の組で返します。"""
+    yield from load_items()
+    yield from load_buildings()
+    yield from load_recipes(validate)
 
-    for item in load_buildings():
-        yield item
+    yield Condition, dict(id = 'Onboarding',
+                          kind = 'onboarding',
+                          index = 0,
+                          name = '初期から開放済み',
+                          link_anchor = '',
+                          time = datetime.timedelta(seconds=0))
 
-    for item in load_recipes():
-        yield item
+    yield from load_milestones()
+    yield from load_researches()
 
-    yield Condition(id = 'Onboarding',
-                    kind = 'onboarding',
-                    index = 0,
-                    name = '初期から開放済み',
-                    link_anchor = '',
-                    time = datetime.timedelta(seconds=0))
 
-    for item in load_milestones():
-        yield item
+def insert_seeddata(conn: Connection, validate: bool = False) -> int:
+    """シードデータをテーブルごとにまとめて挿入し、挿入した行数を返します。
 
-    for item in load_researches():
-        yield item
+    ORMを経由せず、テーブルごとに1回のexecutemanyで挿入します。
+    トランザクションは呼び出し側で管理してください。
+    """
+    rows_by_model = {model: [] for model in SEED_MODELS}
+    for model, row in make_seedrows(validate):
+        rows_by_model[model].append(row)
+
+    count = 0
+    for model, rows in rows_by_model.items():
+        if not rows:
+            continue
+
+        # executemanyではすべての行が同じ列を持つ必要があるため、足りない列を補います。
+        names = [column.name for column in model.__table__.columns]
+        rows = [{name: row.get(name) for name in names} for row in rows]
+        conn.execute(model.__table__.insert(), rows)
+        count += len(rows)
+    return count
 
 
 def load_yaml(filename: str) -> any:
@@ -53,44 +78,47 @@ def load_yaml(filename: str) -> any:
     path = os.path.join(dir, 'seeddata', filename)
 
     with open(path, encoding='utf-8') as fp:
-        return yaml.safe_load(fp)
+        return yaml.load(fp, Loader=YamlLoader)
 
 
-def load_items() -> Iterator[Item]:
+def load_items() -> Iterator[SeedRow]:
     """素材／装備品などの情報テーブルを読み込みます。"""
     items_data = load_yaml('items.yaml')
 
     for i, data in enumerate(items_data):
         item_id = to_id(data['id'])
 
-        yield Item(id = item_id,
-                   name = data['name'],
-                   index = i,
-                   kind = data['type'],
-                   category = data['category'],
-                   coupons = int(data.get('coupons', '0')),
-                   wiki_id = data.get('wiki_id', item_id))
+        yield Item, dict(id = item_id,
+                         name = data['name'],
+                         index = i,
+                         kind = data['type'],
+                         category = data['category'],
+                         wiki_id = data.get('wiki_id', item_id))
 
 
-def load_buildings() -> Iterator[Building]:
+def load_buildings() -> Iterator[SeedRow]:
     buildings_data = load_yaml('buildings.yaml')
 
     for i, data in enumerate(buildings_data):
         building_id = to_id(data['id'])
 
-        yield Building(id = building_id,
-                       name = data['name'],
-                       index = i,
-                       category = data['category'],
-                       subcategory = data['subcategory'],
-                       power = to_int(data.get('power', None)),
-                       area = to_float(data.get('area', None)),
-                       max_inputs = to_int(data.get('max_inputs', None)),
-                       max_outputs = to_int(data.get('max_outputs', None)),
-                       wiki_id = data.get('wiki_id', building_id))
+        yield Building, dict(id = building_id,
+                             name = data['name'],
+                             index = i,
+                             category = data['category'],
+                             subcategory = data['subcategory'],
+                             power = to_int(data.get('power', None)),
+                             area = to_float(data.get('area', None)),
+                             max_inputs = to_int(data.get('max_inputs', None)),
+                             max_outputs = to_int(data.get('max_outputs', None)),
+                             wiki_id = data.get('wiki_id', building_id))
+
 
+def load_recipes(validate: bool = False) -> Iterator[SeedRow]:
+    """レシピを読み込みます。
 
-def load_recipes() -> Iterator[Recipe]:
+    validateがTrueのときは、handyファイルの分速と計算した分速が異なる場合に警告を出します。
+    """
     recipes_data = load_yaml('recipes.yaml')
     #recipes_data.extend(load_yaml('recipes_burning.yaml'))
 
@@ -115,18 +143,18 @@ def load_recipes() -> Iterator[Recipe]:
         if conditions:
             condition_id = to_id(conditions[0])
 
-        yield Recipe(id = recipe_id,
-                     name = f"{prefix}{data['name']}",
-                     index = i,
-                     wiki_id = data.get('wiki_id', to_id(recipe_id)),
-                     link_anchor = data.get('link_anchor', ''),
-                     alternate = data['alternate'],
-                     power = data.get('power', None),
-                     condition_id = condition_id,
-                     building_id = building_id,
-                     building2_id = building2_id,
-                     production_time = production_time,
-                     production_time2 = production_time2)
+        yield Recipe, dict(id = recipe_id,
+                           name = f"{prefix}{data['name']}",
+                           index = i,
+                           wiki_id = data.get('wiki_id', to_id(recipe_id)),
+                           link_anchor = data.get('link_anchor', ''),
+                           alternate = data['alternate'],
+                           power = data.get('power', None),
+                           condition_id = condition_id,
+                           building_id = building_id,
+                           building2_id = building2_id,
+                           production_time = production_time,
+                           production_time2 = production_time2)
 
         # production_timeが0のときは、minute=0とします。
         def get_minute(amount: float) -> float:
@@ -138,66 +166,58 @@ def load_recipes() -> Iterator[Recipe]:
             else:
                 return 60.0 * amount / production_time
 
-        for j, ing in enumerate(data['ingredients']):
-            amount = float(ing['amount'])
-            if float(ing['minute']) != get_minute(amount):
-                print(f'invalid minute value {building_id} handy:{ing['minute']} calc:{get_minute(amount)}')
-            yield RecipeItem(recipe_id = recipe_id,
-                             item_id = to_id(ing['id']),
-                             role = 'ingredient',
-                             index = j,
-                             amount = amount,
-                             minute = get_minute(amount))
-
-        for j, prod in enumerate(data['products']):
-            amount = float(prod['amount'])
-            if float(prod['minute']) != get_minute(amount):
-                print(f'invalid minute value {building_id} handy:{prod['minute']} calc:{get_minute(amount)}')
-            yield RecipeItem(recipe_id = recipe_id,
-                             item_id = to_id(prod['id']),
-                             role = 'product',
-                             index = j,
-                             amount = amount,
-                             minute = get_minute(amount))
-
-
-def load_milestones() -> Iterator[Condition]:
+        for role, key in (('ingredient', 'ingredients'), ('product', 'products')):
+            for j, data_item in enumerate(data[key]):
+                amount = float(data_item['amount'])
+                minute = get_minute(amount)
+                if validate and float(data_item['minute']) != minute:
+                    logging.warning('invalid minute value %s handy:%s calc:%s',
+                                    building_id, data_item['minute'], minute)
+                yield RecipeItem, dict(recipe_id = recipe_id,
+                                       item_id = to_id(data_item['id']),
+                                       role = role,
+                                       index = j,
+                                       amount = amount,
+                                       minute = minute)
+
+
+def load_milestones() -> Iterator[SeedRow]:
     milestones_data = load_yaml('milestones.yaml')
 
     for i, data in enumerate(milestones_data):
         condition_id = to_id(data['id'])
 
-        yield Condition(id = condition_id,
-                        kind = 'milestone',
-                        index = i,
-                        name = data['name'],
-                        tier = int(data['tier']),
-                        link_anchor = data.get('link_anchor', ''),
-                        time = datetime.timedelta(seconds=data['time']))
+        yield Condition, dict(id = condition_id,
+                              kind = 'milestone',
+                              index = i,
+                              name = data['name'],
+                              tier = int(data['tier']),
+                              link_anchor = data.get('link_anchor', ''),
+                              time = datetime.timedelta(seconds=data['time']))
 
         for j, item in enumerate(data['items']):
-            yield ConditionItem(condition_id = condition_id,
-                                item_id = to_id(item['id']),
-                                index = j,
-                                amount = int(item['amount']))
+            yield ConditionItem, dict(condition_id = condition_id,
+                                      item_id = to_id(item['id']),
+                                      index = j,
+                                      amount = int(item['amount']))
 
 
-def load_researches() -> Iterator[Condition]:
+def load_researches() -> Iterator[SeedRow]:
     researches_data = load_yaml('researches.yaml')
 
     for i, data in enumerate(researches_data):
         condition_id = to_id(data['id'])
 
-        yield Condition(id = condition_id,
-                        kind = 'research',
-                        index = i,
-                        name = data['name'],
-                        category = data['category'],
-                        link_anchor = data.get('link_anchor', ''),
-                        time = datetime.timedelta(seconds=data['time']))
+        yield Condition, dict(id = condition_id,
+                              kind = 'research',
+                              index = i,
+                              name = data['name'],
+                              category = data['category'],
+                              link_anchor = data.get('link_anchor', ''),
+                              time = datetime.timedelta(seconds=data['time']))
 
         for j, item in enumerate(data['items']):
-            yield ConditionItem(condition_id = condition_id,
-                                item_id = to_id(item['id']),
-                                index = j,
-                                amount = int(item['amount']))
+            yield ConditionItem, dict(condition_id = condition_id,
+                                      item_id = to_id(item['id']),
+                                      index = j,
+                                      amount = int(item['amount']))
@@ -0,0 +1,135 @@
+"""同じキーの処理が実行中であれば、新しく実行せずにその結果を共有します。
+
+共有リンクなどから同じ内容のプランナーのリクエストが同時に届いた場合に、
+CBCの計算を1回にまとめるために使います。
+"""
+import asyncio
+import threading
+from typing import Any, Awaitable, Callable, Hashable
+
+import metrics
+
+CALLS = metrics.Counter(
+    'sf_singleflight_calls_total',
+    'Single-flight calls by role (leader runs the work, shared waits for it).',
+    ['name', 'role'])
+
+_flights: list['SingleFlight | AsyncSingleFlight'] = []
+
+
+def _waiting() -> dict[tuple, float]:
+    values = {}
+    for flight in _flights:
+        values[(flight.name,)] = values.get((flight.name,), 0) + flight.waiting
+    return values
+
+
+def _dedup_ratio() -> dict[tuple, float]:
+    """呼び出しのうち、実行中の結果を共有した割合です。"""
+    names = {flight.name for flight in _flights}
+    values = {}
+    for name in names:
+        leader = CALLS.get(name, 'leader')
+        shared = CALLS.get(name, 'shared')
+        values[(name,)] = shared / (leader + shared) if leader + shared else 0.0
+    return values
+
+
+metrics.Gauge('sf_singleflight_waiting', 'Calls currently waiting for a shared result.',
+              ['name'], _waiting)
+metrics.Gauge('sf_singleflight_dedup_ratio', 'Share of calls served by another call.',
+              ['name'], _dedup_ratio)
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error: BaseException | None = None
+
+
+class SingleFlight:
+    """スレッドで処理するリクエスト(Flask)用です。"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.waiting = 0
+        self._calls: dict[Hashable, _Call] = {}
+        self._lock = threading.Lock()
+        _flights.append(self)
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                self.waiting += 1
+
+        if not leader:
+            CALLS.inc(self.name, 'shared')
+            call.done.wait()
+            with self._lock:
+                self.waiting -= 1
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        CALLS.inc(self.name, 'leader')
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as ex:
+            call.error = ex
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+class AsyncSingleFlight:
+    """イベントループで処理するリクエスト(asgi.py)用です。
+
+    イベントループのスレッドからのみ使うため、ロックは使いません。
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.waiting = 0
+        self._calls: dict[Hashable, asyncio.Future] = {}
+        _flights.append(self)
+
+    def in_flight(self, key: Hashable) -> bool:
+        return key in self._calls
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        future = self._calls.get(key)
+        if future is not None:
+            CALLS.inc(self.name, 'shared')
+            self.waiting += 1
+            try:
+                # 待っている側がキャンセルされても、実行中の処理は止めません。
+                return await asyncio.shield(future)
+            finally:
+                self.waiting -= 1
+
+        CALLS.inc(self.name, 'leader')
+        future = asyncio.get_running_loop().create_future()
+        # 待っている側がいない場合に、例外が取得されなかったという警告を出さないようにします。
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._calls[key] = future
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as ex:
+            future.set_exception(ex)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del self._calls[key]
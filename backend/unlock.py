@@ -0,0 +1,85 @@
+"""ティア・マイルストーン・研究ごとに開放されるレシピを、ビットセットで保持します。
+
+レシピはRecipe.indexの順に1ビットずつ割り当て、開放状態はPythonのintで表します。
+開放状態からのレシピの絞り込みは、JOINの代わりにビットのOR/ANDで行います。
+"""
+import re
+from typing import Iterable
+
+from catalog import Catalog, get_catalog
+from dataset import Dataset
+
+TIER_PATTERN = re.compile(r'^Tier_(\d+)_')
+
+
+class UnlockIndex:
+    def __init__(self, catalog: Catalog):
+        recipes = sorted(catalog.recipes.values(), key=lambda r: r.index)
+        self.recipe_ids = [recipe.id for recipe in recipes]
+        self.bits = {id: 1 << i for i, id in enumerate(self.recipe_ids)}
+        self.all_bits = (1 << len(self.recipe_ids)) - 1
+
+        # レシピのcondition_idは、条件のIDと大文字/小文字が違うものがあります。
+        conditions = {id.lower(): cond for id, cond in catalog.conditions.items()}
+
+        # 最初から開放されているレシピ
+        #   条件が見つからないもの(AWESOMEショップなど)もここに含めます。
+        self.base_bits = 0
+        self.milestone_bits: dict[str, int] = {}
+        self.research_bits: dict[str, int] = {}
+        tier_only: dict[int, int] = {}
+        for recipe in recipes:
+            bit = self.bits[recipe.id]
+            cond = conditions.get((recipe.condition_id or '').lower())
+            if cond is not None and cond.kind == 'milestone':
+                self.milestone_bits[cond.id] = self.milestone_bits.get(cond.id, 0) | bit
+                tier_only[cond.tier] = tier_only.get(cond.tier, 0) | bit
+            elif cond is not None and cond.kind == 'research':
+                self.research_bits[cond.id] = self.research_bits.get(cond.id, 0) | bit
+            elif cond is None and (m := TIER_PATTERN.match(recipe.condition_id or '')):
+                # 条件の名前の表記揺れ(Signalling など)は、IDのティアで判断します。
+                tier = int(m.group(1))
+                tier_only[tier] = tier_only.get(tier, 0) | bit
+            else:
+                self.base_bits |= bit
+
+        # tier_bits[t] はティアt以下のマイルストーンをすべて達成したときのレシピです。
+        self.tier_bits = []
+        bits = self.base_bits
+        for tier in range(max(tier_only, default=0) + 1):
+            bits |= tier_only.get(tier, 0)
+            self.tier_bits.append(bits)
+
+    def mask(self, tier: int | None = None, milestones: Iterable[str] = (),
+             researches: Iterable[str] = ()) -> int:
+        """開放状態から、使えるレシピのビットセットを作ります。
+
+        tierにはそのティアまでのマイルストーンをすべて達成したものとして扱い、
+        milestones/researchesには個別に達成したマイルストーンと研究を指定します。
+        """
+        bits = self.base_bits
+        if tier is not None and tier >= 0:
+            bits |= self.tier_bits[min(tier, len(self.tier_bits) - 1)]
+        for id in milestones:
+            bits |= self.milestone_bits.get(id, 0)
+        for id in researches:
+            bits |= self.research_bits.get(id, 0)
+        return bits
+
+    def is_unlocked(self, recipe_id: str, mask: int) -> bool:
+        return bool(self.bits.get(recipe_id, 0) & mask)
+
+    def select(self, mask: int) -> list[str]:
+        """ビットセットに含まれるレシピのIDを、Recipe.indexの順に返します。"""
+        mask &= self.all_bits
+        result = []
+        while mask:
+            low = mask & -mask
+            result.append(self.recipe_ids[low.bit_length() - 1])
+            mask ^= low
+        return result
+
+
+def get_unlock_index(dataset: Dataset) -> UnlockIndex:
+    return dataset.cached('unlock_index',
+                          lambda: UnlockIndex(get_catalog(dataset)))
@@ -1,29 +1,34 @@
 #!/usr/bin/python
-import re
 import sys
-import requests
-import lxml.html
 import yaml
 from collections import namedtuple
+from lxml.etree import XPath
 from typing import Iterator
-from util import to_id, class_to_dict, print_elem
+from fetcher import fetch_page
+from util import to_id, class_to_dict, print_elem, find_heading, iter_tables, parse_table
 
 TBuilding = namedtuple('TBuilding', ['id', 'category', 'subcategory'])
 
+# 行ごとに使うXPathは、あらかじめコンパイルしておきます。
+BUILDING_ROWS = XPath('tbody/tr[count(td) >= 3]')
+CELLS = XPath('td')
+LINKS = XPath('a')
+IMAGES = XPath('img')
+
 
 def parse_buildings(elem: any) -> Iterator[TBuilding]:
-    children = elem.xpath('tbody/tr[count(td) >= 3]')
+    children = BUILDING_ROWS(elem)
 
     for child in children:
-        tds = child.xpath('td')
+        tds = CELLS(child)
         if len(tds) > 0:
             yield parse_building(tds[0])
 
 
 def parse_building(elem: any) -> str:
-    children = elem.xpath('a')
+    children = LINKS(elem)
     if len(children) == 0:
-        children = elem.xpath('img')
+        children = IMAGES(elem)
     if len(children) == 0:
         print_elem(elem)
 
@@ -31,15 +36,15 @@ def parse_building(elem: any) -> str:
 
 
 def load_building_from_wiki(page_name: str, category: str, subcategory: str) -> list[TBuilding]:
-    res = requests.get(f'https://satisfactory.wiki.gg/wiki/{page_name}')
-    html = re.sub(r'&\S*;', '', res.text)
-    tree = lxml.html.fromstring(html)
+    text = fetch_page(page_name)
+    start = find_heading(text, 'h2', 'Types')
+    if start is None:
+        return []
 
     buildings = []
 
-    tables = tree.xpath('//h2[span[@id="Types"]]/following::table[contains(@class, "wikitable")]')
-    for table in tables:
-        for building_id in parse_buildings(table):
+    for _, html in iter_tables(text, 'wikitable', start):
+        for building_id in parse_buildings(parse_table(html)):
             buildings.append(TBuilding(to_id(building_id), category, subcategory))
 
     return buildings
@@ -0,0 +1,185 @@
+#!/usr/bin/python
+"""wikiのページを取得します。
+
+すべてのローダーで1つのrequests.Sessionを共有し、接続を使い回します。
+取得はプロセス全体で毎秒FETCH_RATE回までに制限し、失敗した場合は間隔を空けて
+再試行します。fetch_pagesでは、複数のページをFETCH_WORKERSのスレッドで並列に取得します。
+
+SF_WIKI_BASE_URLを変えると、保存したページを返すローカルのサーバーなどからも取得できます。
+
+取得したページはCACHE_DIRに保存し、次回からはETag/Last-Modifiedで更新を確認して、
+変わっていなければ保存したものを使います。ページの本文は内容のハッシュ値を名前にして
+保存するため、同じ内容のページは1つのファイルを共有します。
+SF_FETCH_MODE=offlineの場合は通信を行わず、保存したページだけを使います。
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator, TypeVar
+from urllib.parse import quote
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# ページを取得するwikiのURL (ページ名の前まで)
+WIKI_BASE_URL = os.environ.get('SF_WIKI_BASE_URL', 'https://satisfactory.wiki.gg/wiki')
+
+# 並列に取得するページ数
+FETCH_WORKERS = int(os.environ.get('SF_FETCH_WORKERS', '4'))
+
+# 1秒あたりのリクエスト数の上限 (0の場合は制限しません)
+FETCH_RATE = float(os.environ.get('SF_FETCH_RATE', '2'))
+
+# 再試行の回数と、再試行までの間隔(秒)の基準値 (1, 2, 4, 8...秒と増えます)
+FETCH_RETRIES = 5
+FETCH_BACKOFF = 1.0
+
+FETCH_TIMEOUT = 30
+
+# 取得したページを保存するディレクトリ
+CACHE_DIR = os.environ.get('SF_WIKI_CACHE_DIR',
+                           os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'wiki'))
+
+# 取得方法
+#   online : 保存したページは、更新されているかを確認してから使います。(デフォルト)
+#   offline: 通信せずに、保存したページだけを使います。保存されていなければエラーです。
+FETCH_MODE = os.environ.get('SF_FETCH_MODE', 'online')
+
+# 取得したページ (digest: 本文のsha256)
+WikiPage = namedtuple('WikiPage', ['name', 'text', 'digest'])
+
+T = TypeVar('T')
+
+
+class RateLimiter:
+    """呼び出しの間隔を、すべてのスレッドで合わせて 1 / rate 秒以上空けます。"""
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+def create_session() -> requests.Session:
+    retry = Retry(total=FETCH_RETRIES, backoff_factor=FETCH_BACKOFF,
+                  status_forcelist=(429, 500, 502, 503, 504),
+                  allowed_methods=('GET',), respect_retry_after_header=True)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(FETCH_WORKERS, 1),
+                          max_retries=retry)
+    session = requests.Session()
+    session.headers['User-Agent'] = 'satisfactory-wikitool'
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+session = create_session()
+rate_limiter = RateLimiter(FETCH_RATE)
+
+
+def page_url(page_name: str) -> str:
+    return f'{WIKI_BASE_URL.rstrip("/")}/{quote(page_name)}'
+
+
+def write_file(path: str, data: bytes) -> None:
+    """一時ファイルに書き込んでから置き換え、並列に読み書きしても壊れないようにします。"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'wb') as fp:
+        fp.write(data)
+    os.replace(tmp_path, path)
+
+
+def _meta_path(url: str) -> str:
+    return os.path.join(CACHE_DIR, 'pages', hashlib.sha1(url.encode('utf-8')).hexdigest() + '.json')
+
+
+def _object_path(digest: str) -> str:
+    return os.path.join(CACHE_DIR, 'objects', digest[:2], digest)
+
+
+def _load_cached(url: str) -> tuple[dict, str] | None:
+    """保存したページの情報と本文を返します。なければNoneを返します。"""
+    try:
+        with open(_meta_path(url), encoding='utf-8') as fp:
+            meta = json.load(fp)
+        with open(_object_path(meta['digest']), 'rb') as fp:
+            return meta, fp.read().decode('utf-8')
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def _save_cached(url: str, res: requests.Response, text: str) -> str:
+    data = text.encode('utf-8')
+    digest = hashlib.sha256(data).hexdigest()
+    if not os.path.exists(_object_path(digest)):
+        write_file(_object_path(digest), data)
+
+    meta = {
+        'url': url,
+        'digest': digest,
+        'etag': res.headers.get('ETag'),
+        'last_modified': res.headers.get('Last-Modified'),
+    }
+    write_file(_meta_path(url), json.dumps(meta, indent=1).encode('utf-8'))
+    return digest
+
+
+def get_page(page_name: str) -> WikiPage:
+    """ページを取得します。保存したページが更新されていなければ、それを返します。"""
+    url = page_url(page_name)
+    cached = _load_cached(url)
+    if FETCH_MODE == 'offline':
+        if cached is None:
+            raise FileNotFoundError(f'"{page_name}" is not cached ({url})')
+        meta, text = cached
+        return WikiPage(page_name, text, meta['digest'])
+
+    headers = {}
+    if cached is not None:
+        meta, _ = cached
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+    rate_limiter.wait()
+    res = session.get(url, headers=headers, timeout=FETCH_TIMEOUT)
+    if res.status_code == 304 and cached is not None:
+        meta, text = cached
+        return WikiPage(page_name, text, meta['digest'])
+
+    res.raise_for_status()
+    # 保存したページを返すサーバーなどでは文字コードが指定されないため、UTF-8として扱います。
+    if 'charset' not in res.headers.get('Content-Type', ''):
+        res.encoding = 'utf-8'
+    text = res.text
+    return WikiPage(page_name, text, _save_cached(url, res, text))
+
+
+def fetch_page(page_name: str) -> str:
+    """ページのHTMLを取得します。"""
+    return get_page(page_name).text
+
+
+def fetch_pages(page_names: Iterable[str], load: Callable[[str], T]) -> Iterator[tuple[str, T]]:
+    """ページごとにloadを並列に呼び出し、(ページ名, 結果)をページの順番で返します。
+
+    loadは、ページ名を受け取りfetch_pageで取得して解析する関数です。
+    """
+    page_names = list(page_names)
+    with ThreadPoolExecutor(max(FETCH_WORKERS, 1)) as executor:
+        yield from zip(page_names, executor.map(load, page_names))
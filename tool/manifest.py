@@ -0,0 +1,120 @@
+#!/usr/bin/python
+"""ページの内容のハッシュ値と、そのページの解析結果を対応付けて保存します。
+
+前回から内容が変わっていないページは解析を省略し、保存した結果を使います。
+パーサー(ローダーのモジュールとutil.py)を修正した場合は、すべてのページを解析し直します。
+
+save_recordsはseeddataのYAMLを前回の内容と比べ、追加・削除・変更された項目を表示して、
+変更がある場合だけ書き込みます。
+"""
+import hashlib
+import inspect
+import json
+import os
+import threading
+import yaml
+from collections import namedtuple
+from typing import Any, Callable, Generic, TypeVar
+
+import util
+from fetcher import get_page, write_file
+
+# 解析結果を保存するディレクトリ
+MANIFEST_DIR = os.environ.get('SF_MANIFEST_DIR',
+                              os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                           '.cache', 'manifest'))
+
+# 前回のYAMLと比べて、追加・削除・変更された項目のID
+RecordDiff = namedtuple('RecordDiff', ['added', 'removed', 'changed'])
+
+T = TypeVar('T')
+
+
+def source_digest(parse: Callable) -> str:
+    """パーサーのモジュールとutil.pyのソースのハッシュ値です。"""
+    sha = hashlib.sha256()
+    for path in (inspect.getsourcefile(parse), util.__file__):
+        with open(path, 'rb') as fp:
+            sha.update(fp.read())
+    return sha.hexdigest()
+
+
+class PageManifest(Generic[T]):
+    """ページごとの解析結果を保持します。loadは複数のスレッドから呼び出せます。
+
+    encode/decodeは、解析結果とJSONに保存できる値を相互に変換します。
+    """
+
+    def __init__(self, name: str, parse: Callable[[str], T],
+                 encode: Callable[[T], Any], decode: Callable[[Any], T]):
+        self.name = name
+        self.path = os.path.join(MANIFEST_DIR, f'{name}.json')
+        self.parse = parse
+        self.encode = encode
+        self.decode = decode
+        self.parser = source_digest(parse)
+        self.parsed = 0
+        self.reused = 0
+        self._pages: dict[str, dict] = {}
+        self._old_pages: dict[str, dict] = {}
+        self._lock = threading.Lock()
+
+        try:
+            with open(self.path, encoding='utf-8') as fp:
+                data = json.load(fp)
+            if data.get('parser') == self.parser:
+                self._old_pages = data['pages']
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def load(self, page_name: str) -> T:
+        """ページを取得し、内容が前回と同じであれば保存した解析結果を返します。"""
+        page = get_page(page_name)
+        entry = self._old_pages.get(page_name)
+        if entry is not None and entry['digest'] == page.digest:
+            with self._lock:
+                self._pages[page_name] = entry
+                self.reused += 1
+            return self.decode(entry['records'])
+
+        result = self.parse(page.text)
+        with self._lock:
+            self._pages[page_name] = {'digest': page.digest, 'records': self.encode(result)}
+            self.parsed += 1
+        return result
+
+    def save(self) -> None:
+        """今回読み込んだページの解析結果を保存します。"""
+        data = {'parser': self.parser, 'pages': self._pages}
+        write_file(self.path, json.dumps(data, ensure_ascii=False).encode('utf-8'))
+        print(f'{self.name}: {self.parsed} pages parsed, {self.reused} pages unchanged')
+
+
+def diff_records(old: list[dict], new: list[dict]) -> RecordDiff:
+    old_by_id = {record['id']: record for record in old}
+    new_by_id = {record['id']: record for record in new}
+    return RecordDiff(
+        [id for id in new_by_id if id not in old_by_id],
+        [id for id in old_by_id if id not in new_by_id],
+        [id for id, record in new_by_id.items()
+         if id in old_by_id and old_by_id[id] != record])
+
+
+def save_records(path: str, records: list[dict], kind: str) -> RecordDiff:
+    """YAMLの前回の内容と比べて変更点を表示し、変わっている場合だけ書き込みます。"""
+    old = []
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as fp:
+            old = yaml.safe_load(fp) or []
+
+    diff = diff_records(old, records)
+    print(f'{kind}: {len(diff.added)} added, {len(diff.removed)} removed, '
+          f'{len(diff.changed)} changed')
+    for mark, ids in zip('+-~', diff):
+        for id in ids:
+            print(f'  {mark} {id}')
+
+    if old != records:
+        with open(path, 'w', encoding='utf-8') as fp:
+            yaml.safe_dump(records, fp, allow_unicode=True, sort_keys=False)
+    return diff
@@ -2,8 +2,9 @@
 import logging
 import yaml
 from attrdict import AttrDict
-from milestone_loader import load_milestones_from_wiki
-from util import TMilestone, find_item, class_to_dict
+from manifest import PageManifest, save_records
+from milestone_loader import parse_milestones_page
+from util import TMilestone, index_by_id, find_item, class_to_dict, milestone_from_dict
 
 
 def load_handy_milestones() -> list[AttrDict]:
@@ -13,18 +14,15 @@ def load_handy_milestones() -> list[AttrDict]:
     return [AttrDict(milestone) for milestone in handy_milestones]
 
 handy_milestones = load_handy_milestones()
+handy_milestones_by_id = index_by_id(handy_milestones, str.lower)
 
 
 def find_handy_milestone(id: str) -> TMilestone | None:
-    for hmilestone in handy_milestones:
-        if hmilestone.id.lower() == id.lower():
-            return hmilestone
-    return None
+    return handy_milestones_by_id.get(id.lower())
 
 
 def save_milestones(milestones: any) -> None:
-    with open('../backend/seeddata/milestones.yaml', 'w', encoding='utf-8') as fp:
-        yaml.safe_dump(milestones, fp, allow_unicode=True, sort_keys=False)
+    save_records('../backend/seeddata/milestones.yaml', milestones, 'milestones')
 
 
 def get_full_id(milestone: TMilestone) -> str:
@@ -69,7 +67,9 @@ def milestone_to_dict(milestone: TMilestone) -> dict | None:
 milestones = []
 handy_milestone_set = set(hmilestone['id'] for hmilestone in handy_milestones)
 
-for milestone in load_milestones_from_wiki():
+manifest = PageManifest('milestones', parse_milestones_page, class_to_dict,
+                        lambda data: [milestone_from_dict(dic) for dic in data])
+for milestone in manifest.load('Milestones'):
     dic = milestone_to_dict(milestone)
     if dic is not None:
         milestones.append(dic)
@@ -79,3 +79,4 @@ for id in handy_milestone_set:
     logging.error('Error: Not handled milestone "%s".', id)
 
 save_milestones(milestones)
+manifest.save()
@@ -1,14 +1,19 @@
 #!/usr/bin/python
 import datetime
-import re
-import requests
-import lxml.html
+from lxml.etree import XPath
 from typing import Iterator
-from util import to_id, normalize_value, TMilestone, TItemAmount
+from fetcher import fetch_page
+from util import to_id, normalize_value, iter_tables, parse_table, TMilestone, TItemAmount
+
+# 行ごとに使うXPathは、あらかじめコンパイルしておきます。
+ROWS = XPath('tbody/tr')
+CELLS = XPath('td')
+LINKS = XPath('a')
+ITEM_LINKS = XPath('span/a')
 
 
 def parse_milestones(elem: any, tier: int) -> Iterator[TMilestone]:
-    children = elem.xpath('tbody/tr')
+    children = ROWS(elem)
     milestone = None
 
     for child in children:
@@ -25,11 +30,11 @@ def parse_milestones(elem: any, tier: int) -> Iterator[TMilestone]:
 
 
 def parse_firstrow(elem: any, tier: int) -> TMilestone:
-    elems = elem.xpath('td')
+    elems = CELLS(elem)
 
-    mid = elems[1].xpath('a')[0].tail.strip()
+    mid = LINKS(elems[1])[0].tail.strip()
     amount = normalize_value(elems[2].text)
-    item_id = to_id(elems[2].xpath('span/a')[0].attrib['title'])
+    item_id = to_id(ITEM_LINKS(elems[2])[0].attrib['title'])
 
     t = datetime.datetime.strptime(elems[3].text, "%M:%S")
     time = t.minute * 60 + t.second
@@ -39,20 +44,21 @@ def parse_firstrow(elem: any, tier: int) -> TMilestone:
 
 
 def parse_otherrow(elem: any) -> TItemAmount:
-    elems = elem.xpath('td')
+    elems = CELLS(elem)
 
     amount = normalize_value(elems[0].text)
-    item_id = to_id(elems[0].xpath('span/a')[0].attrib['title'])
+    item_id = to_id(ITEM_LINKS(elems[0])[0].attrib['title'])
 
     return TItemAmount(item_id, amount)
 
 
-def load_milestones_from_wiki() -> Iterator[TMilestone]:
-    res = requests.get(f'https://satisfactory.wiki.gg/wiki/Milestones')
-    html = re.sub(r'&\S*;', '', res.text)
-    tree = lxml.html.fromstring(html)
+def load_milestones_from_wiki() -> list[TMilestone]:
+    return parse_milestones_page(fetch_page('Milestones'))
+
 
-    tables = tree.xpath('//table[contains(@class, "milestoneTable")]')
-    for i, table in enumerate(tables):
-        for milestone in parse_milestones(table, i):
-            yield milestone
+def parse_milestones_page(text: str) -> list[TMilestone]:
+    milestones = []
+    tables = iter_tables(text, 'milestoneTable')
+    for i, (_, html) in enumerate(tables):
+        milestones.extend(parse_milestones(parse_table(html), i))
+    return milestones
@@ -2,8 +2,11 @@
 import logging
 import yaml
 from attrdict import AttrDict
-from recipe_loader import load_recipe_from_wiki
-from util import items, to_id, TRecipe, find_building, find_item, class_to_dict
+from fetcher import fetch_pages
+from manifest import PageManifest, save_records
+from recipe_loader import parse_recipe_page
+from util import (items, index_by_id, normalize_id, to_id, TRecipe, find_building, find_item,
+                  class_to_dict, recipe_from_dict)
 
 
 def load_handy_recipes() -> list[AttrDict]:
@@ -16,18 +19,23 @@ def load_handy_recipes() -> list[AttrDict]:
     return [AttrDict(recipe) for recipe in handy_recipes]
 
 handy_recipes = load_handy_recipes()
+handy_recipes_by_id = index_by_id(handy_recipes)
 
 
 def find_handy_recipe(id: str) -> TRecipe | None:
-    for hrecipe in handy_recipes:
-        if to_id(hrecipe.id.lower()) == to_id(id.lower()):
-            return hrecipe
-    return None
+    return handy_recipes_by_id.get(normalize_id(id))
 
 
 def save_recipes(recipes: any) -> None:
-    with open('../backend/seeddata/recipes.yaml', 'w', encoding='utf-8') as fp:
-        yaml.safe_dump(recipes, fp, allow_unicode=True, sort_keys=False)
+    save_records('../backend/seeddata/recipes.yaml', recipes, 'recipes')
+
+
+def encode_page(page: tuple[list[TRecipe], list[TRecipe]]) -> list:
+    return [class_to_dict(recipes) for recipes in page]
+
+
+def decode_page(data: list) -> tuple[list[TRecipe], list[TRecipe]]:
+    return tuple([recipe_from_dict(dic) for dic in recipes] for recipes in data)
 
 
 def recipe_to_dict(recipe: TRecipe) -> dict | None:
@@ -111,9 +119,10 @@ handy_recipe_set = set(to_id(recipe['id']) for recipe in handy_recipes)
 pages = [item.id for item in items]
 pages.append("Miner")
 
-for page_id in pages:
-    obtaining_recipes, usage_recipes = load_recipe_from_wiki(page_id)
-
+# ページは並列に取得し、結果はページの順番で処理します。
+# 前回から内容が変わっていないページは、解析せずに前回の結果を使います。
+manifest = PageManifest('recipes', parse_recipe_page, encode_page, decode_page)
+for page_id, (obtaining_recipes, usage_recipes) in fetch_pages(pages, manifest.load):
     # 生産物用のレシピ
     for recipe in obtaining_recipes:
         dic = recipe_to_dict(recipe)
@@ -137,3 +146,4 @@ for recipe_id in handy_recipe_set:
 recipes = remove_duplicates_by_id(recipes)
 recipes.extend(building_recipes.values())
 save_recipes(recipes)
+manifest.save()
@@ -1,9 +1,24 @@
 #!/usr/bin/python
 import re
-import requests
-import lxml.html
+from lxml.etree import XPath
 from typing import Iterator
-from util import to_id, normalize_value, TRecipe, TRecipeItem
+from fetcher import fetch_page
+from util import (to_id, normalize_value, find_heading, iter_tables, parse_table,
+                  TRecipe, TRecipeItem)
+
+# 行や素材ごとに使うXPathは、あらかじめコンパイルしておきます。
+RECIPE_ROWS = XPath('tbody/tr[count(td) >= 5]')
+CELLS = XPath('td')
+ALTERNATE = XPath('span[contains(@class, "recipe-alternate")]')
+BUILDINGS = XPath('div[@class="recipe-building"]')
+BUILDING_ENERGY = XPath('span[@class="recipe-energy"]')
+BUILDING_ICON = XPath('span/img')
+LINE_BREAK = XPath('br')
+RECIPE_ITEMS = XPath('div/div[@class="recipe-item"]')
+ITEM_NAME = XPath('span[@class="item-name"]')
+ITEM_AMOUNT = XPath('span[@class="item-amount"]')
+ITEM_MINUTE = XPath('span[@class="item-minute"]')
+LINKS = XPath('a')
 
 
 def normalize_condition_id(name: str) -> str:
@@ -13,16 +28,16 @@ def normalize_condition_id(name: str) -> str:
 
 
 def parse_recipes(elem: any) -> Iterator[TRecipe]:
-    children = elem.xpath('tbody/tr[count(td) >= 5]')
+    children = RECIPE_ROWS(elem)
 
     for child in children:
-        yield parse_recipe(child.xpath('td'))
+        yield parse_recipe(CELLS(child))
 
 
 def parse_recipe(elems: any) -> TRecipe:
     id = to_id(elems[0].text)
 
-    alternate_elems = elems[0].xpath('span[contains(@class, "recipe-alternate")]')
+    alternate_elems = ALTERNATE(elems[0])
     alternate = len(alternate_elems) > 0
 
     # Craft Bench と Constructor など、複数の施設が含まれる可能性があります。
@@ -54,7 +69,7 @@ def parse_power(value: str) -> int:
 
 
 def parse_buildings(building_root: any) -> Iterator[tuple[str, str, int]]:
-    building_elems = building_root.xpath('div[@class="recipe-building"]')
+    building_elems = BUILDINGS(building_root)
 
     for elem in building_elems:
         building_id = to_id(elem[0].text)
@@ -63,18 +78,18 @@ def parse_buildings(building_root: any) -> Iterator[tuple[str, str, int]]:
         #     raise Exception()
 
         power = None
-        power_elem = elem.xpath('span[@class="recipe-energy"]')
+        power_elem = BUILDING_ENERGY(elem)
         if len(power_elem) >= 1:
             power = parse_power(power_elem[0].text)
 
-        span_elem = elem.xpath('span/img')
+        span_elem = BUILDING_ICON(elem)
         if len(span_elem) >= 1:
             production_time = span_elem[0].tail
             production_time = normalize_value(production_time)
             yield (building_id, production_time, power)
             continue
 
-        br_elem = elem.xpath('br')
+        br_elem = LINE_BREAK(elem)
         if len(br_elem) >= 1:
             production_time = br_elem[0].tail
             production_time = normalize_value(production_time)
@@ -85,17 +100,17 @@ def parse_buildings(building_root: any) -> Iterator[tuple[str, str, int]]:
 
 
 def parse_recipe_items(items_root: any, has_minute: bool) -> Iterator[TRecipeItem]:
-    recipe_elems = items_root.xpath('div/div[@class="recipe-item"]')
+    recipe_elems = RECIPE_ITEMS(items_root)
 
     for elem in recipe_elems:
-        id = elem.xpath('span[@class="item-name"]')[0].text
+        id = ITEM_NAME(elem)[0].text
         id = to_id(id)
 
-        amount = elem.xpath('span[@class="item-amount"]')[0].text
+        amount = ITEM_AMOUNT(elem)[0].text
         amount = normalize_value(amount)
 
         if has_minute:
-            minute = elem.xpath('span[@class="item-minute"]')[0].text
+            minute = ITEM_MINUTE(elem)[0].text
         else:
             minute = '0'
         minute = normalize_value(minute)
@@ -108,32 +123,42 @@ def parse_milestones(items_root: any) -> Iterator[str]:
     if label and 'Onboarding' in label:
         yield label.strip()
 
-    for tag in items_root.xpath('a'):
+    for tag in LINKS(items_root):
         prefix = normalize_condition_id(tag.text)
         postfix = normalize_condition_id(tag.tail)
         yield f'{prefix} {postfix}'
 
 
 def load_recipe_from_wiki(item_name: str) -> tuple[list[TRecipe], list[TRecipe]]:
-    res = requests.get(f'https://satisfactory.wiki.gg/wiki/{item_name}')
-    html = re.sub(r'&\S*;', '', res.text)
-    tree = lxml.html.fromstring(html)
+    return parse_recipe_page(fetch_page(item_name))
 
+
+def find_recipe_table(text: str, sections: list[tuple[str, str]]) -> tuple[int, str] | None:
+    """いずれかの見出しの後にある、最初のレシピの表を(位置, 表のHTML)で返します。"""
+    for tag, id in sections:
+        start = find_heading(text, tag, id)
+        if start is not None:
+            for table in iter_tables(text, 'recipetable', start):
+                return table
+    return None
+
+
+def parse_recipe_page(text: str) -> tuple[list[TRecipe], list[TRecipe]]:
+    """素材のページから、その素材を作成するレシピと使用するレシピを取得します。
+
+    ページ全体は解析せず、見出しの後にあるレシピの表だけを解析します。
+    """
     obtaining_recipes = []
     usage_recipes = []
 
     # このアイテムが使用されるレシピ一覧
-    usage = tree.xpath('//h2[span[@id="Usage"]]/following::table[contains(@class, "recipetable")][1]')
-    if len(usage) == 0:
-        usage = tree.xpath('//h3[span[@id="Used_to_craft"]]/following::table[contains(@class, "recipetable")][1]')
-    if len(usage) == 1:
-        usage_recipes = list(parse_recipes(usage[0]))
+    usage = find_recipe_table(text, [('h2', 'Usage'), ('h3', 'Used_to_craft')])
+    if usage is not None:
+        usage_recipes = list(parse_recipes(parse_table(usage[1])))
 
     # このアイテムを作成するレシピ一覧
-    obtaining = tree.xpath('//h2[span[@id="Obtaining"]]/following::table[contains(@class, "recipetable")][1]')
-    if len(obtaining) == 0:
-        obtaining = tree.xpath('//h3[span[@id="Crafting"]]/following::table[contains(@class, "recipetable")][1]')
-    if len(obtaining) == 1 and obtaining != usage:
-        obtaining_recipes = list(parse_recipes(obtaining[0]))
+    obtaining = find_recipe_table(text, [('h2', 'Obtaining'), ('h3', 'Crafting')])
+    if obtaining is not None and obtaining != usage:
+        obtaining_recipes = list(parse_recipes(parse_table(obtaining[1])))
 
     return (obtaining_recipes, usage_recipes)
@@ -2,8 +2,9 @@
 import logging
 import yaml
 from attrdict import AttrDict
-from research_loader import load_researches_from_wiki
-from util import TResearch, find_item, class_to_dict
+from manifest import PageManifest, save_records
+from research_loader import parse_researches_page
+from util import TResearch, index_by_id, find_item, class_to_dict, research_from_dict
 
 
 def find_handy_researches() -> list[AttrDict]:
@@ -13,18 +14,15 @@ def find_handy_researches() -> list[AttrDict]:
     return [AttrDict(research) for research in handy_researches]
 
 handy_researches = find_handy_researches()
+handy_researches_by_id = index_by_id(handy_researches, str.lower)
 
 
 def find_handy_research(id: str) -> TResearch | None:
-    for hresearch in handy_researches:
-        if hresearch.id.lower() == id.lower():
-            return hresearch
-    return None
+    return handy_researches_by_id.get(id.lower())
 
 
 def save_researches(researches: any) -> None:
-    with open('../backend/seeddata/researches.yaml', 'w', encoding='utf-8') as fp:
-        yaml.safe_dump(researches, fp, allow_unicode=True, sort_keys=False)
+    save_records('../backend/seeddata/researches.yaml', researches, 'researches')
 
 
 def get_full_id(research: TResearch) -> str:
@@ -62,7 +60,9 @@ def research_to_dict(research: TResearch) -> dict | None:
 researches = []
 handy_research_set = set(hresearch['id'] for hresearch in handy_researches)
 
-for research in load_researches_from_wiki():
+manifest = PageManifest('researches', parse_researches_page, class_to_dict,
+                        lambda data: [research_from_dict(dic) for dic in data])
+for research in manifest.load('MAM'):
     dic = research_to_dict(research)
     if dic is not None:
         researches.append(dic)
@@ -72,3 +72,4 @@ for id in handy_research_set:
     logging.error('Error: Not handled research "%s".', id)
 
 save_researches(researches)
+manifest.save()
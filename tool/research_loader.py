@@ -1,14 +1,19 @@
 #!/usr/bin/python
 import datetime
-import re
-import requests
-import lxml.html
+from lxml.etree import XPath
 from typing import Iterator
-from util import to_id, normalize_value, TResearch, TItemAmount
+from fetcher import fetch_page
+from util import to_id, normalize_value, iter_tables, parse_table, TResearch, TItemAmount
+
+# 行ごとに使うXPathは、あらかじめコンパイルしておきます。
+ROWS = XPath('tbody/tr')
+CELLS = XPath('td')
+LINKS = XPath('a')
+ITEM_LINKS = XPath('span/a')
 
 
 def parse_researches(elem: any, category: tuple[str, str]) -> Iterator[TResearch]:
-    children = elem.xpath('tbody/tr')
+    children = ROWS(elem)
     research = None
     index = 1
 
@@ -27,11 +32,11 @@ def parse_researches(elem: any, category: tuple[str, str]) -> Iterator[TResearch
 
 
 def parse_firstrow(elem: any, category: tuple, index: int) -> TResearch:
-    elems = elem.xpath('td')
+    elems = CELLS(elem)
 
-    sid = elems[1].xpath('a')[0].tail.strip()
+    sid = LINKS(elems[1])[0].tail.strip()
     amount = normalize_value(elems[2].text)
-    item_id = to_id(elems[2].xpath('span/a')[0].attrib['title'])
+    item_id = to_id(ITEM_LINKS(elems[2])[0].attrib['title'])
 
     t = datetime.datetime.strptime(elems[3].text, "%M:%S")
     time = t.minute * 60 + t.second
@@ -42,10 +47,10 @@ def parse_firstrow(elem: any, category: tuple, index: int) -> TResearch:
 
 
 def parse_otherrow(elem: any) -> TItemAmount:
-    elems = elem.xpath('td')
+    elems = CELLS(elem)
 
     amount = normalize_value(elems[0].text)
-    item_id = to_id(elems[0].xpath('span/a')[0].attrib['title'])
+    item_id = to_id(ITEM_LINKS(elems[0])[0].attrib['title'])
 
     return TItemAmount(item_id, amount)
 
@@ -61,15 +66,16 @@ categories = [
     ('Sulfur', '硫黄', 'Sulfur'),
 ]
 
-def load_researches_from_wiki() -> Iterator[TResearch]:
-    res = requests.get(f'https://satisfactory.wiki.gg/wiki/MAM')
-    html = re.sub(r'&\S*;', '', res.text)
-    tree = lxml.html.fromstring(html)
+def load_researches_from_wiki() -> list[TResearch]:
+    return parse_researches_page(fetch_page('MAM'))
+
 
-    tables = tree.xpath('//table[contains(@class, "researchTable")]')
-    for i, table in enumerate(tables):
+def parse_researches_page(text: str) -> list[TResearch]:
+    researches = []
+    tables = iter_tables(text, 'researchTable')
+    for i, (_, html) in enumerate(tables):
         if i >= len(categories):
             continue
         cat = categories[i]
-        for research in parse_researches(table, cat):
-            yield research
+        researches.extend(parse_researches(parse_table(html), cat))
+    return researches
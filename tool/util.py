@@ -1,8 +1,9 @@
 #!/usr/bin/python
 import re
 import yaml
-import lxml
+import lxml.html
 from collections import namedtuple
+from typing import Iterator
 from attrdict import AttrDict
 
 
@@ -14,6 +15,10 @@ TItemAmount = namedtuple('TItemAmount', ['id', 'amount'])
 TMilestone = namedtuple('TMilestone', ['id', 'tier', 'time', 'items'])
 TResearch = namedtuple('TResearch', ['id', 'category', 'time', 'link_anchor', 'items'])
 
+# ページから表を切り出すための正規表現です。(MediaWikiは属性の値を必ず"で囲みます)
+TABLE_TAG = re.compile(r'<(/?)table\b([^>]*)>', re.IGNORECASE)
+CLASS_ATTR = re.compile(r'\bclass="([^"]*)"')
+
 
 def to_id(word: str) -> str:
     word = re.sub(r'\s*[(]([.\d]+)\s*m[)]\s*$', r'_\1m', word)
@@ -34,6 +39,19 @@ def to_id(word: str) -> str:
             return word
 
 
+def normalize_id(id: str) -> str:
+    """大文字・小文字などの違いを無視してIDを比べるための、正規化したIDです。"""
+    return to_id(id.lower())
+
+
+def index_by_id(records: list, normalize=normalize_id) -> dict:
+    """正規化したIDから項目を引く辞書を作ります。IDが重複する場合は先のものを使います。"""
+    index = {}
+    for record in records:
+        index.setdefault(normalize(record.id), record)
+    return index
+
+
 def normalize_value(value: str) -> str:
     value = value.replace(r'sec', '')
     value = value.replace(r'/min', '')
@@ -47,6 +65,22 @@ def normalize_value(value: str) -> str:
         return float(value)
 
 
+def recipe_from_dict(dic: dict) -> TRecipe:
+    """class_to_dictで変換したレシピを元に戻します。"""
+    return TRecipe(**{**dic,
+                      'ingredients': [TRecipeItem(**item) for item in dic['ingredients']],
+                      'products': [TRecipeItem(**item) for item in dic['products']]})
+
+
+def milestone_from_dict(dic: dict) -> TMilestone:
+    return TMilestone(**{**dic, 'items': [TItemAmount(**item) for item in dic['items']]})
+
+
+def research_from_dict(dic: dict) -> TResearch:
+    return TResearch(**{**dic, 'category': tuple(dic['category']),
+                        'items': [TItemAmount(**item) for item in dic['items']]})
+
+
 def class_to_dict(obj: any) -> dict:
     def recurse_dict(dic: dict) -> dict:
         return {key: class_to_dict(value) for key, value in dic.items()}
@@ -61,6 +95,47 @@ def class_to_dict(obj: any) -> dict:
         return obj
 
 
+def find_heading(text: str, tag: str, id: str) -> int | None:
+    """<tag>の子に<span id="id">がある見出しを探し、その位置を返します。なければNoneを返します。"""
+    m = re.search(rf'<{tag}\b[^>]*>(?:(?!</{tag}>).)*?<span\b[^>]*\bid="{re.escape(id)}"',
+                  text, re.DOTALL)
+    return m.start() if m else None
+
+
+def iter_tables(text: str, class_name: str, start: int = 0) -> Iterator[tuple[int, str]]:
+    """text[start:]から、classにclass_nameを含む表を探し、(位置, 表のHTML)を順に返します。
+
+    ページ全体を解析せずに、必要な表だけをparse_tableで解析するために使います。
+    """
+    begin = None
+    depth = 0
+    for m in TABLE_TAG.finditer(text, start):
+        if not m[1]:
+            depth += 1
+            attr = CLASS_ATTR.search(m[2])
+            if begin is None and attr and class_name in attr[1]:
+                begin, begin_depth = m.start(), depth
+        else:
+            if begin is not None and depth == begin_depth:
+                yield begin, text[begin:m.end()]
+                begin = None
+            depth -= 1
+
+
+def parse_table(html: str) -> any:
+    """表のHTMLを解析します。
+
+    文字参照は解析時に展開し、&nbsp;(\\xa0) は値や名前の邪魔になるため取り除きます。
+    """
+    table = lxml.html.fragment_fromstring(html)
+    for elem in table.iter():
+        if elem.text and '\xa0' in elem.text:
+            elem.text = elem.text.replace('\xa0', '')
+        if elem.tail and '\xa0' in elem.tail:
+            elem.tail = elem.tail.replace('\xa0', '')
+    return table
+
+
 def print_elem(elem: any) -> None:
     print(lxml.html.tostring(elem, pretty_print=True).decode('utf-8'))
 
@@ -72,13 +147,11 @@ def load_items() -> list[AttrDict]:
     return [AttrDict(item) for item in items]
 
 items = load_items()
+items_by_id = index_by_id(items)
 
 
 def find_item(id: str) -> any:
-    for item in items:
-        if to_id(item.id.lower()) == to_id(id.lower()):
-            return item
-    return None
+    return items_by_id.get(normalize_id(id))
 
 
 def load_buildings() -> list[AttrDict]:
@@ -88,10 +161,8 @@ def load_buildings() -> list[AttrDict]:
     return [AttrDict(building) for building in buildings]
 
 buildings = load_buildings()
+buildings_by_id = index_by_id(buildings)
 
 
 def find_building(id: str) -> any:
-    for building in buildings:
-        if to_id(building.id.lower()) == to_id(id.lower()):
-            return building
-    return None
+    return buildings_by_id.get(normalize_id(id))